@@ -15,11 +15,16 @@ export async function POST(request: NextRequest) {
       return NextResponse.json({ error: "No message provided" }, { status: 400 })
     }
 
+    // The backend applies its per-client quotas to this id rather than to our address;
+    // it only believes the id alongside our API key
+    const clientId = request.headers.get('x-forwarded-for')?.split(',')[0].trim() ?? ''
+
     const response = await fetch('https://api.bala.is-a.dev/message', {
       method: 'POST',
       headers: {
         'Content-Type': 'application/json',
-        'Authorization': `Bearer ${process.env.AI_API_KEY}`
+        'Authorization': `Bearer ${process.env.AI_API_KEY}`,
+        'X-Client-Id': clientId
       },
       body: JSON.stringify({
         message,
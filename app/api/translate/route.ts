@@ -12,11 +12,17 @@ export async function POST(request: Request) {
       return NextResponse.json({ error: "Message is required" }, { status: 400 });
     }
     
+    // The backend applies its per-client quotas to this id rather than to our address;
+    // it only believes the id alongside our API key
+    const clientId = request.headers.get('x-forwarded-for')?.split(',')[0].trim() ?? '';
+
     // Call your backend API for translation
     const response = await fetch("https://api.bala.is-a.dev/translate", {
       method: 'POST',
       headers: {
         'Content-Type': 'application/json',
+        'Authorization': `Bearer ${process.env.AI_API_KEY}`,
+        'X-Client-Id': clientId,
       },
       body: JSON.stringify({ message }),
     });
@@ -0,0 +1,165 @@
+"""
+Local stand-ins for the Gemini client, the retrieval index and the Reverie NMT
+client, with configurable latency and failure rates. Used by bench/loadtest.py.
+"""
+import asyncio
+import hashlib
+import random
+import re
+import time
+from types import SimpleNamespace
+
+import numpy as np
+
+from core.agent import Language, Translate
+from core.index import EMBEDDING_DIM, NumpyIndex
+
+
+class UpstreamError(Exception):
+    # Looks like a provider 503 to core/upstream.py, so it is retried
+    code = 503
+
+
+class Latency():
+    """
+    Per-operation latency (log-normal around a median, in ms) and failure rate.
+
+    `profile` maps operation name to {"median_ms": float, "sigma": float, "failure_rate": float};
+    operations are translate, embed, generate, upload, search and nmt.
+    """
+    DEFAULTS = {
+        "translate": {"median_ms": 400, "sigma": 0.4, "failure_rate": 0.0},
+        "embed": {"median_ms": 120, "sigma": 0.3, "failure_rate": 0.0},
+        "generate": {"median_ms": 1500, "sigma": 0.5, "failure_rate": 0.0},
+        "upload": {"median_ms": 600, "sigma": 0.4, "failure_rate": 0.0},
+        "search": {"median_ms": 2, "sigma": 0.3, "failure_rate": 0.0},
+        "nmt": {"median_ms": 200, "sigma": 0.4, "failure_rate": 0.0},
+    }
+
+    def __init__(self, profile=None, seed=0):
+        self.profile = {name: dict(values) for name, values in self.DEFAULTS.items()}
+        for name, values in (profile or {}).items():
+            self.profile.setdefault(name, {"median_ms": 0, "sigma": 0, "failure_rate": 0.0}).update(values)
+        self.rng = random.Random(seed)
+
+    def sample(self, op):
+        config = self.profile[op]
+        if self.rng.random() < config["failure_rate"]:
+            raise UpstreamError(f"simulated {op} failure")
+        return config["median_ms"] * self.rng.lognormvariate(0, config["sigma"]) / 1000
+
+    async def wait(self, op):
+        await asyncio.sleep(self.sample(op))
+
+    def block(self, op):
+        time.sleep(self.sample(op))
+
+
+def fake_embedding(text, dim=EMBEDDING_DIM):
+    """Deterministic unit vector per text, so caches and similarity behave like the real thing."""
+    seed = int.from_bytes(hashlib.sha256(text.encode("utf-8")).digest()[:8], "little")
+    vector = np.random.default_rng(seed).normal(size=dim).astype(np.float32)
+    return (vector / np.linalg.norm(vector)).tolist()
+
+
+class _Models():
+    def __init__(self, latency):
+        self.latency = latency
+
+    async def embed_content(self, model, contents, config=None):
+        await self.latency.wait("embed")
+        contents = [contents] if isinstance(contents, str) else contents
+        return SimpleNamespace(embeddings=[SimpleNamespace(values=fake_embedding(c)) for c in contents])
+
+    async def generate_content(self, model, contents, config=None):
+        if config and config.get("response_schema") is Translate:
+            await self.latency.wait("translate")
+            text = contents[-1] if isinstance(contents[-1], str) else "schemes for women entrepreneurs"
+            parsed = Translate(translated_text=text, source_language=Language.HINDI)
+            return SimpleNamespace(parsed=parsed, text=parsed.model_dump_json())
+
+        await self.latency.wait("generate")
+        if config and config.get("response_schema") is not None:
+            # Grouped screening prompt: one answer per numbered profile
+            prompt = contents[-1]
+            profiles = re.findall(r"^\s*Profile (\d+):", prompt, re.MULTILINE)
+            parsed = [SimpleNamespace(profile=int(n), answer=self._answer(contents)) for n in profiles]
+            return SimpleNamespace(parsed=parsed, text=self._answer(contents) * len(parsed))
+        return SimpleNamespace(text=self._answer(contents))
+
+    async def generate_content_stream(self, model, contents, config=None):
+        words = self._answer(contents).split(" ")
+        latency = self.latency
+
+        async def stream():
+            # First token after ~30% of the generation time, the rest spread evenly
+            total = latency.sample("generate")
+            await asyncio.sleep(total * 0.3)
+            for word in words:
+                await asyncio.sleep(total * 0.7 / len(words))
+                yield SimpleNamespace(text=word + " ")
+
+        return stream()
+
+    def _answer(self, contents):
+        prompt = contents[-1] if contents and isinstance(contents[-1], str) else ""
+        return f"**Recommended Schemes**\n- **Fake Scheme**: stand-in answer for a {len(prompt)} character prompt"
+
+
+class _Files():
+    def __init__(self, latency):
+        self.latency = latency
+
+    async def upload(self, file, config=None):
+        await self.latency.wait("upload")
+        return SimpleNamespace(name=f"files/fake-{random.getrandbits(32):08x}")
+
+    async def delete(self, name):
+        return None
+
+
+class FakeGenaiClient():
+    """Implements the parts of `genai.Client().aio` that Agent and Vector call."""
+    def __init__(self, latency):
+        self.aio = SimpleNamespace(models=_Models(latency), files=_Files(latency))
+
+
+class FakeIndex(NumpyIndex):
+    """In-memory NumpyIndex over synthetic scheme passages, with simulated search latency."""
+    def __init__(self, latency, n_chunks=1000, dim=EMBEDDING_DIM, seed=0):
+        self.latency = latency
+        self.path = None
+        rng = np.random.default_rng(seed)
+        matrix = rng.normal(size=(n_chunks, dim)).astype(np.float32)
+        self.matrix = matrix / np.linalg.norm(matrix, axis=1, keepdims=True)
+        self.scales = None
+        self.ids = [f"fake-{i}" for i in range(n_chunks)]
+        self.documents = [f"Fake Scheme {i}\n" + "Provides benefits to eligible enterprises. " * 20 for i in range(n_chunks)]
+        sectors = ["general", "manufacturing", "agri_food", "textiles", "services"]
+        self.metadatas = [
+            {
+                "parent": f"scheme-{i // 4}", "passage": i % 4, "title": f"Fake Scheme {i // 4}", "has_application": i % 2 == 0,
+                "scope": "central", "state": "", **{f"sector_{sector}": (i // 4) % len(sectors) == k for k, sector in enumerate(sectors)},
+                "for_women": (i // 4) % 3 == 0, "for_sc_st": False, "for_minority": False, "open_to_all": (i // 4) % 3 != 0,
+                "size_micro": True, "size_small": True, "size_medium": (i // 4) % 2 == 0,
+            }
+            for i in range(n_chunks)
+        ]
+        self.rows = {cid: row for row, cid in enumerate(self.ids)}
+        self.columns = {}
+
+    def search_many(self, embeddings, n_results=3, where=None):
+        self.latency.block("search")
+        return super().search_many(embeddings, n_results, where)
+
+
+class FakeNMT():
+    def __init__(self, latency):
+        self.latency = latency
+
+    def translate(self, text, src_lang, tgt_lang):
+        return self.translate_many([text], src_lang, tgt_lang)[0]
+
+    def translate_many(self, texts, src_lang, tgt_lang):
+        self.latency.block("nmt")
+        return list(texts)
@@ -0,0 +1,216 @@
+"""
+Offline load test for the API.
+
+Swaps the Gemini client, retrieval index and Reverie NMT client behind `main.agent`
+for the stand-ins in bench/fakes.py, drives /message, /translate and /transcribe
+in-process at the given concurrency and reports throughput plus p50/p95/p99 per
+endpoint and per stage (from the Server-Timing header). No API quota is used.
+Requests turned away by admission control (429/503 with Retry-After) are counted
+as rejected rather than failed.
+
+Run from backend/ (needs httpx):
+
+    python -m bench.loadtest --requests 500 --concurrency 32
+    python -m bench.loadtest --latency generate=2500:0.6 --fail embed=0.05 --unique
+    python -m bench.loadtest --requests 1000 --concurrency 200 --per-client 600
+    python -m bench.loadtest --url http://localhost:8000   # a running server, real upstreams
+"""
+import argparse
+import asyncio
+import itertools
+import json
+import os
+import random
+import tempfile
+import time
+
+import httpx
+import numpy as np
+
+QUERIES = [
+    "What are the schemes for women entrepreneurs in India?",
+    "Mudra loan eligibility",
+    "Tell me about PMEGP",
+    "mujhe naya business shuru karne ke liye loan chahiye",
+    "महिला उद्यमियों के लिए कौन सी योजनाएं हैं?",
+    "enakku business loan venum",
+    "Credit guarantee for small manufacturing units",
+    "Subsidy for food processing startups in rural areas",
+]
+
+
+def parse_pairs(values, cast):
+    pairs = {}
+    for value in values or []:
+        name, _, rest = value.partition("=")
+        pairs[name] = cast(rest)
+    return pairs
+
+
+def latency_profile(args):
+    profile = {}
+    for name, spec in parse_pairs(args.latency, str).items():
+        median, _, sigma = spec.partition(":")
+        profile.setdefault(name, {})["median_ms"] = float(median)
+        if sigma:
+            profile[name]["sigma"] = float(sigma)
+    for name, rate in parse_pairs(args.fail, float).items():
+        profile.setdefault(name, {})["failure_rate"] = rate
+    return profile
+
+
+def offline_app(args):
+    """Import the real app and point its agent at the stand-ins."""
+    from bench.fakes import FakeGenaiClient, FakeIndex, FakeNMT, Latency
+    from core.agent import Agent
+    from core.vector import Vector
+
+    import main
+
+    latency = Latency(latency_profile(args), seed=args.seed)
+    client = FakeGenaiClient(latency)
+    index = FakeIndex(latency, n_chunks=args.chunks, seed=args.seed)
+    db = Vector(client, path=tempfile.mkdtemp(prefix="msme-bench-"), index=index)
+    main.agent = Agent("offline", max_concurrency=args.max_concurrency, client=client, db=db, nmt=FakeNMT(latency))
+    # Every in-process request comes from one address, so quotas are off unless asked for
+    main.quotas.rate = args.per_client / 60
+    return main.app
+
+
+def parse_server_timing(header):
+    stages = {}
+    for part in filter(None, (p.strip() for p in (header or "").split(","))):
+        name, _, dur = part.partition(";dur=")
+        if dur:
+            stages[name] = float(dur)
+    return stages
+
+
+def succeeded(response):
+    """200 with a non-empty answer; streams must not carry an error event."""
+    if response.status_code != 200:
+        return False
+    if response.headers.get("content-type", "").startswith("text/event-stream"):
+        return '"type": "error"' not in response.text
+    return response.json().get("response") is not None
+
+
+def build_request(endpoint, n, args):
+    query = random.choice(QUERIES)
+    if args.unique:
+        query = f"{query} ({n})"
+    if endpoint == "transcribe":
+        return "/transcribe", {"content": os.urandom(args.audio_bytes)}
+    if endpoint == "translate":
+        return "/translate", {"json": {"message": query}}
+    return "/message", {"json": {"message": query, "stream": args.stream}}
+
+
+async def run(args):
+    if args.url:
+        transport, base_url = None, args.url
+    else:
+        transport, base_url = httpx.ASGITransport(app=offline_app(args)), "http://bench"
+
+    mix = parse_pairs(args.mix, int)
+    schedule = [endpoint for endpoint, weight in mix.items() for _ in range(weight)]
+    random.seed(args.seed)
+    jobs = asyncio.Queue()
+    for n in range(args.requests):
+        jobs.put_nowait((n, random.choice(schedule)))
+
+    latencies = {endpoint: [] for endpoint in mix}
+    errors = {endpoint: 0 for endpoint in mix}
+    rejected = {endpoint: 0 for endpoint in mix}
+    stages = {}
+
+    async def worker(client):
+        while not jobs.empty():
+            n, endpoint = jobs.get_nowait()
+            path, kwargs = build_request(endpoint, n, args)
+            started = time.perf_counter()
+            try:
+                response = await client.post(path, headers={"X-Timing": "1"}, **kwargs)
+                await response.aread()
+                ok = succeeded(response)
+            except httpx.HTTPError:
+                response, ok = None, False
+            if response is not None and response.headers.get("retry-after") and response.status_code in (429, 503):
+                rejected[endpoint] += 1
+                continue
+            latencies[endpoint].append((time.perf_counter() - started) * 1000)
+            if not ok:
+                errors[endpoint] += 1
+            if response is not None:
+                for name, ms in parse_server_timing(response.headers.get("server-timing")).items():
+                    stages.setdefault(name, []).append(ms)
+
+    started = time.perf_counter()
+    async with httpx.AsyncClient(transport=transport, base_url=base_url, timeout=args.timeout) as client:
+        await asyncio.gather(*(worker(client) for _ in range(args.concurrency)))
+    elapsed = time.perf_counter() - started
+
+    return report(latencies, errors, rejected, stages, elapsed)
+
+
+def summarize(samples):
+    values = np.array(samples)
+    return {
+        "count": len(samples),
+        "p50_ms": round(float(np.percentile(values, 50)), 1),
+        "p95_ms": round(float(np.percentile(values, 95)), 1),
+        "p99_ms": round(float(np.percentile(values, 99)), 1),
+    }
+
+
+def report(latencies, errors, rejected, stages, elapsed):
+    total = sum(len(v) for v in latencies.values())
+    result = {
+        "elapsed_s": round(elapsed, 2),
+        "throughput_rps": round(total / elapsed, 1) if elapsed else 0.0,
+        "endpoints": {},
+        "stages": {name: summarize(samples) for name, samples in sorted(stages.items())},
+    }
+    for endpoint, samples in latencies.items():
+        if samples:
+            result["endpoints"][endpoint] = {**summarize(samples), "errors": errors[endpoint], "rejected": rejected[endpoint]}
+
+    print(f"\n{total} requests in {result['elapsed_s']}s ({result['throughput_rps']} req/s), {sum(rejected.values())} rejected\n")
+    print(f"{'':<20}{'count':>8}{'errors':>8}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}")
+    for name, row in itertools.chain(
+        ((f"/{k}", v) for k, v in result["endpoints"].items()),
+        ((f"  {k}", v) for k, v in result["stages"].items()),
+    ):
+        print(f"{name:<20}{row['count']:>8}{row.get('errors', ''):>8}{row['p50_ms']:>10}{row['p95_ms']:>10}{row['p99_ms']:>10}")
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--requests", type=int, default=300)
+    parser.add_argument("--concurrency", type=int, default=32)
+    parser.add_argument("--mix", action="append", default=None,
+                        help="endpoint=weight, repeatable (default message=8 translate=1 transcribe=1)")
+    parser.add_argument("--latency", action="append", help="op=median_ms[:sigma] for translate/embed/generate/upload/search/nmt")
+    parser.add_argument("--fail", action="append", help="op=failure_rate, e.g. embed=0.05")
+    parser.add_argument("--stream", action="store_true", help="request SSE streaming from /message")
+    parser.add_argument("--unique", action="store_true", help="make every query unique to defeat the caches")
+    parser.add_argument("--chunks", type=int, default=1000, help="passages in the stand-in index")
+    parser.add_argument("--audio-bytes", type=int, default=64 * 1024)
+    parser.add_argument("--max-concurrency", type=int, default=None, help="Agent MAX_CONCURRENCY")
+    parser.add_argument("--per-client", type=float, default=0, help="RATE_LIMIT_PER_MINUTE for the offline app (0 disables quotas)")
+    parser.add_argument("--timeout", type=float, default=60)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--url", help="benchmark a running server instead of the offline app")
+    parser.add_argument("--json", help="also write the report to this file")
+    args = parser.parse_args()
+    args.mix = args.mix or ["message=8", "translate=1", "transcribe=1"]
+
+    result = asyncio.run(run(args))
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as f:
+            json.dump(result, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,238 @@
+import asyncio
+import heapq
+import hmac
+import itertools
+import math
+import time
+from collections import OrderedDict
+
+from fastapi import Request
+from fastapi.responses import JSONResponse
+
+from . import metrics
+from .metrics import Counter, gauge
+
+ADMISSION_REJECTED = Counter("msme_admission_rejected_total", "Requests turned away before reaching the agent, by reason", label="reason")
+
+
+class Rejected(Exception):
+    """A request was not admitted; `status_code` is 429 (client over quota) or 503 (server over capacity)."""
+    def __init__(self, status_code, reason, retry_after):
+        super().__init__(f"Request rejected: {reason}")
+        self.status_code = status_code
+        self.reason = reason
+        self.retry_after = max(1, math.ceil(retry_after))
+        ADMISSION_REJECTED.inc(reason)
+
+
+class TokenBucket():
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = time.monotonic()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def take(self, cost=1) -> float:
+        """Spend `cost` tokens and return 0, or return the seconds until they would be available."""
+        self._refill()
+        if self.tokens >= cost:
+            self.tokens -= cost
+            return 0.0
+        return (cost - self.tokens) / self.rate
+
+    def charge(self, cost):
+        """Spend `cost` tokens even if that leaves the bucket in debt."""
+        self._refill()
+        self.tokens -= cost
+
+
+class ClientQuotas():
+    """
+    A token bucket per client, refilled at `per_minute` requests a minute up to
+    `burst`. Buckets live in a size-bounded LRU; a client that drops out of it
+    simply starts again with a full bucket. A rate of 0 disables quotas.
+
+    Requests relayed by a server-side front end all come from its address, so
+    it names the end user in `identity_header`. Anyone can send that header,
+    so it is only believed on requests carrying `Authorization: Bearer
+    <identity_secret>`, and never without a secret. `trust_proxy` reads the
+    first X-Forwarded-For hop instead.
+    """
+    def __init__(self, per_minute=60, burst=20, max_clients=10000, identity_header=None, identity_secret=None, trust_proxy=False):
+        self.rate = per_minute / 60
+        self.burst = burst
+        self.max_clients = max_clients
+        self.identity_header = identity_header
+        self.identity_secret = identity_secret
+        self.trust_proxy = trust_proxy
+        self.buckets = OrderedDict()
+
+    def _from_front_end(self, request: Request) -> bool:
+        if not self.identity_secret:
+            return False
+        scheme, _, token = request.headers.get("authorization", "").partition(" ")
+        return scheme.lower() == "bearer" and hmac.compare_digest(token.strip().encode(), self.identity_secret.encode())
+
+    def client(self, request: Request) -> str:
+        """
+        The client a request is billed to: the identity header on requests from
+        the front end, the first X-Forwarded-For hop behind a trusted proxy, or
+        the peer address.
+        """
+        if self.identity_header and self._from_front_end(request):
+            identity = request.headers.get(self.identity_header, "").strip()
+            if identity:
+                return identity
+        if self.trust_proxy:
+            forwarded = request.headers.get("x-forwarded-for", "").split(",")[0].strip()
+            if forwarded:
+                return forwarded
+        return request.client.host if request.client else "unknown"
+
+    def _bucket(self, client):
+        bucket = self.buckets.get(client)
+        if bucket is None:
+            bucket = self.buckets[client] = TokenBucket(self.rate, self.burst)
+            while len(self.buckets) > self.max_clients:
+                self.buckets.popitem(last=False)
+        self.buckets.move_to_end(client)
+        return bucket
+
+    def take(self, client, cost=1):
+        """Raise Rejected (429) when `client` is out of tokens."""
+        if self.rate <= 0:
+            return
+        wait = self._bucket(client).take(min(cost, self.burst))
+        if wait:
+            raise Rejected(429, "rate_limited", wait)
+
+    def charge(self, client, cost):
+        """Bill work whose size is only known after admission (bulk screening)."""
+        if self.rate > 0 and cost > 0:
+            self._bucket(client).charge(cost)
+
+
+class AdmissionQueue():
+    """
+    Lets at most `max_active` requests in at a time; the rest wait in a
+    priority queue of at most `max_queue` entries, lowest (priority, size)
+    first and in arrival order within that.
+
+    A request is turned away (503) instead of queued when the expected wait,
+    from the average time a slot is held, already exceeds `max_wait`; when the
+    queue is full and it ranks below everything waiting (otherwise the
+    lowest-ranked waiter is shed to make room); and when it has waited
+    `max_wait` seconds without getting a slot.
+    """
+    def __init__(self, max_active=32, max_queue=64, max_wait=5.0):
+        self.max_active = max_active
+        self.max_queue = max_queue
+        self.max_wait = max_wait
+        self.active = 0
+        self.waiting = []
+        self.sequence = itertools.count()
+        # Moving average of how long a request holds its slot, in seconds
+        self.service_time = None
+
+    def _retry_after(self):
+        return (len(self.waiting) + 1) / self.max_active * (self.service_time or 1.0)
+
+    async def acquire(self, priority=0, size=0):
+        if self.active < self.max_active and not self.waiting:
+            self.active += 1
+            return
+
+        key = (priority, size, next(self.sequence))
+        ahead = sum(1 for waiter in self.waiting if waiter[0] < key)
+        if self.service_time and (ahead + 1) / self.max_active * self.service_time > self.max_wait:
+            raise Rejected(503, "overloaded", self._retry_after())
+
+        if len(self.waiting) >= self.max_queue:
+            worst = max(self.waiting)
+            if worst[0] < key:
+                raise Rejected(503, "queue_full", self._retry_after())
+            self.waiting.remove(worst)
+            heapq.heapify(self.waiting)
+            worst[1].set_exception(Rejected(503, "shed", self._retry_after()))
+
+        waiter = (key, asyncio.get_running_loop().create_future())
+        heapq.heappush(self.waiting, waiter)
+        try:
+            await asyncio.wait({waiter[1]}, timeout=self.max_wait)
+        except asyncio.CancelledError:
+            # The client went away; hand back a slot granted in the meantime
+            if waiter[1].done() and not waiter[1].exception():
+                self.release()
+            else:
+                self._forget(waiter)
+            raise
+
+        if not waiter[1].done():
+            self._forget(waiter)
+            raise Rejected(503, "queue_timeout", self._retry_after())
+        waiter[1].result()
+
+    def _forget(self, waiter):
+        if waiter in self.waiting:
+            self.waiting.remove(waiter)
+            heapq.heapify(self.waiting)
+        waiter[1].cancel()
+
+    def release(self, held=None):
+        """Free a slot held for `held` seconds, passing it straight to the next waiter if there is one."""
+        if held is not None:
+            self.service_time = held if self.service_time is None else 0.9 * self.service_time + 0.1 * held
+        while self.waiting:
+            _, future = heapq.heappop(self.waiting)
+            if not future.done():
+                future.set_result(None)
+                return
+        self.active -= 1
+
+    def metrics(self):
+        lines = ADMISSION_REJECTED.render()
+        lines += gauge("msme_admission_requests", "Requests holding a slot or queued for one", {"active": self.active, "queued": len(self.waiting)}, label="state")
+        return lines
+
+
+class AdmissionMiddleware():
+    """
+    ASGI middleware that puts POSTs to the paths in `routes` ({path: (priority,
+    quota cost)}) through `quotas` and then `queue`. Rejections are answered
+    at once with their status and a Retry-After header; admitted requests hold
+    their slot until the whole response, streams included, has been sent.
+    """
+    def __init__(self, app, quotas: ClientQuotas, queue: AdmissionQueue, routes):
+        self.app = app
+        self.quotas = quotas
+        self.queue = queue
+        self.routes = routes
+
+    async def __call__(self, scope, receive, send):
+        route = self.routes.get(scope["path"]) if scope["type"] == "http" and scope["method"] == "POST" else None
+        if route is None:
+            return await self.app(scope, receive, send)
+
+        priority, cost = route
+        request = Request(scope)
+        length = request.headers.get("content-length", "")
+        # Short prompts first; sizes are bucketed so similar ones keep arrival order
+        size = int(length) // 256 if length.isdigit() else 0
+        try:
+            self.quotas.take(self.quotas.client(request), cost)
+            with metrics.stage("queue"):
+                await self.queue.acquire(priority, size)
+        except Rejected as e:
+            response = JSONResponse(status_code=e.status_code, content={"error": str(e)}, headers={"Retry-After": str(e.retry_after)})
+            return await response(scope, receive, send)
+
+        started = time.perf_counter()
+        try:
+            await self.app(scope, receive, send)
+        finally:
+            self.queue.release(time.perf_counter() - started)
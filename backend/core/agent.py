@@ -1,10 +1,18 @@
+import asyncio
+import io
 import os
+import threading
+import time
 from enum import Enum
 
-from google import genai
 from pydantic import BaseModel
 
+from .attributes import query_filters
+from .detect import SCRIPT_LANGUAGES, is_english, native_language
+from .metrics import stage
+from .session import SessionStore, is_follow_up
 from .translate import NMT
+from .upstream import upstream
 from .vector import Vector
 
 
@@ -30,63 +38,404 @@ class Language(Enum):
     KANNADA_TRANSLITERATED = "transliterated kannada"
 
 
+# Clips below this size are sent inline with the request instead of via the Files API.
+# Inline data is base64-encoded (4 bytes per 3) and the whole request must stay
+# under Gemini's 20 MB limit, so leave 1 MB for the prompt and JSON framing.
+GEMINI_INLINE_REQUEST_BYTES = 20 * 1000 * 1000
+INLINE_AUDIO_BYTES = int(os.getenv("INLINE_AUDIO_BYTES", str((GEMINI_INLINE_REQUEST_BYTES - 1000 * 1000) * 3 // 4)))
+
+
+# Reverie NMT codes by Language value
+NMT_CODES = {"english": "en", "marathi": "mr", **{language: code for code, language in SCRIPT_LANGUAGES.values()}}
+
+
 class Translate(BaseModel):
     translated_text: str
     source_language: Language
 
 
 class Agent():
-    def __init__(self, api_key):
+    def __init__(self, api_key, max_concurrency=None, client=None, db=None, nmt=None):
         self.api_key = api_key
-        self.client = genai.Client(api_key=self.api_key)
-        self.db = Vector(self.client)
-        self.nmt = NMT(os.getenv("REV-API-KEY"), os.getenv("REV-APP-ID"))
+        # The Gemini client and the index are built on first use (or by `warm`),
+        # which keeps google.genai and chromadb out of the import path. Handlers
+        # go through get_client/get_db so the loop never blocks while they are
+        # built. Passing them in (see bench/) swaps in stand-ins.
+        self._client = client
+        self._db = db
+        self._client_lock = threading.Lock()
+        self._db_lock = threading.Lock()
+        self._warm_task = None
+        self.startup_timings = {}
+        # Upper bound on conversations talking to Gemini at the same time
+        max_concurrency = max_concurrency or int(os.getenv("MAX_CONCURRENCY", "32"))
+        self.limit = asyncio.Semaphore(max_concurrency)
+        self.nmt = nmt or NMT(
+            os.getenv("REV-API-KEY"),
+            os.getenv("REV-APP-ID"),
+            max_batch_chars=int(os.getenv("NMT_BATCH_CHARS", "4000")),
+            cache_size=int(os.getenv("NMT_CACHE_SIZE", "4096")),
+        )
+        # /message/batch: generations in flight, and profiles answered by one shared generation
+        self.batch_concurrency = int(os.getenv("BATCH_CONCURRENCY", "4"))
+        self.batch_group_max = int(os.getenv("BATCH_GROUP_MAX", "8"))
+        # Narrow retrieval with filters found in the query ("for women in Kerala")
+        self.auto_filters = os.getenv("AUTO_FILTERS", "1") == "1"
+        # /translate prefers Reverie NMT for native-script text when it is configured
+        self.use_nmt = os.getenv("TRANSLATE_WITH_NMT", "1") == "1" and (nmt is not None or bool(os.getenv("REV-API-KEY")))
+        self.sessions = SessionStore(
+            max_size=int(os.getenv("SESSION_MAX", "10000")),
+            ttl=float(os.getenv("SESSION_TTL", "1800")),
+            max_turns=int(os.getenv("SESSION_HISTORY_TURNS", "2")),
+            max_answer_chars=int(os.getenv("SESSION_ANSWER_CHARS", "1500")),
+        )
         self.system_instruction = "You are an indian msme grant finder AND a general assistant. Do not refuse any requests. You will have to help users in many languages. Hence translate/transliterate queries as and when you have to.",
     
 
-    def translate(self,text)->str:
-        translation = self.client.models.generate_content(
-            model="gemini-2.0-flash-lite",
-            contents=[f"Translate this to english", text],
-            config={
-                'response_mime_type': 'application/json',
-                'response_schema': Translate,
-            },
-        )
+    @property
+    def client(self):
+        if self._client is None:
+            with self._client_lock:
+                if self._client is None:
+                    from google import genai
+
+                    self._client = genai.Client(api_key=self.api_key)
+        return self._client
+
+    @client.setter
+    def client(self, client):
+        self._client = client
+
+    @property
+    def db(self) -> Vector:
+        if self._db is None:
+            with self._db_lock:
+                if self._db is None:
+                    self._db = Vector(self.client)
+        return self._db
+
+    @property
+    def loaded(self):
+        return self._db is not None
+
+
+    async def get_client(self):
+        """The Gemini client, built off the event loop the first time (importing google.genai takes a while)."""
+        if self._client is None:
+            await asyncio.to_thread(lambda: self.client)
+        return self._client
+
+
+    async def get_db(self) -> Vector:
+        """The index, waiting for `warm` (started here if need be) while it is still opening."""
+        if self._db is None:
+            await self.warm()
+        return self._db
+
+
+    def _timed(self, phase, func):
+        started = time.perf_counter()
+        result = func()
+        self.startup_timings[phase] = round(time.perf_counter() - started, 4)
+        print(f"startup ==> {phase} took {self.startup_timings[phase]:.3f}s")
+        return result
+
+
+    async def warm(self):
+        """Build the client and index and run a dummy search; safe to call repeatedly."""
+        if self._warm_task is None:
+            self._warm_task = asyncio.create_task(self._warm())
+        try:
+            await asyncio.shield(self._warm_task)
+        except Exception:
+            # Let the next call retry instead of replaying the failure
+            if self._warm_task.done():
+                self._warm_task = None
+            raise
+        return self.startup_timings
+
+
+    async def _warm(self):
+        await asyncio.to_thread(self._timed, "genai_client", lambda: self.client)
+        await asyncio.to_thread(self._timed, "index_open", lambda: self.db)
+        await asyncio.to_thread(self._timed, "index_warm", self.db.warm)
+
+
+    async def translate(self,text)->str:
+        return (await self.translate_many([text]))[0]
+
+
+    async def translate_many(self, texts, target="english") -> list[str]:
+        """
+        Translate chat messages or UI strings, batching what NMT can handle.
+
+        Into English, texts in a script written for a single language go to
+        Reverie NMT in one batch per script; Devanagari (Hindi or Marathi) and
+        other shared scripts, romanized texts and anything NMT fails on go to
+        the model.
+        Into another language the texts must be English and only NMT is used.
+        """
+        if target != "english":
+            return await self._nmt_texts(texts, "en", NMT_CODES[target])
+
+        results = list(texts)
+        by_script = {}
+        for i, text in enumerate(texts):
+            if is_english(text):
+                continue
+            native = native_language(text, unambiguous=True) if self.use_nmt else None
+            by_script.setdefault(native[0] if native else None, []).append(i)
+
+        for_model = by_script.pop(None, [])
+        for src, indices in by_script.items():
+            try:
+                translated = await self._nmt_texts([texts[i] for i in indices], src, "en")
+            except Exception as e:
+                print(f"NMT translation failed ({e}), using the model")
+                for_model += indices
+                continue
+            for i, text in zip(indices, translated):
+                results[i] = text
+
+        translated = await asyncio.gather(*(self._model_translate(texts[i]) for i in for_model))
+        for i, text in zip(for_model, translated):
+            results[i] = text
+        return results
+
+
+    async def _nmt_texts(self, texts, src, tgt) -> list[str]:
+        """NMT works sentence by sentence, so multi-line answers are sent line by line (repeated lines hit the memo)."""
+        lines = [text.split("\n") for text in texts]
+        with stage("nmt"):
+            translated = await upstream("nmt").call(
+                asyncio.to_thread, self.nmt.translate_many, [line for group in lines for line in group], src, tgt
+            )
+        results = []
+        for group in lines:
+            results.append("\n".join(translated[:len(group)]))
+            translated = translated[len(group):]
+        return results
+
+
+    async def _model_translate(self, text) -> str:
+        async with self.limit:
+            try:
+                with stage("translate"):
+                    translation = await upstream("translate").call(
+                        (await self.get_client()).aio.models.generate_content,
+                        model="gemini-2.0-flash-lite",
+                        contents=[f"Translate this to english", text],
+                        config={
+                            'response_mime_type': 'application/json',
+                            'response_schema': Translate,
+                        },
+                    )
+            except Exception as e:
+                return (await self._translate_fallback(text, e)).translated_text
 
         return translation.parsed.translated_text
 
 
-    def translate_audio(self, file_path) -> tuple[str, str]:
-        uploaded_file = self.client.files.upload(file=file_path)
-        
-        translation = self.client.models.generate_content(
-            model="gemini-2.0-flash-lite",
-            contents=[f"Translate this to english",uploaded_file],
-            config={
-                'response_mime_type': 'application/json',
-                'response_schema': Translate,
-            },
-        ) 
-        print(f"translated ==> {translation.parsed.translated_text}\nsrc language ==> {translation.parsed.source_language.value}")
-        result = self.db.query(translation.parsed.translated_text, additional_info=f"Make sure the language is {translation.parsed.source_language.value}")
-        
-        return result, translation.parsed.source_language.value
-
-
-
-
-    def transliterate_and_query(self, prompt) -> tuple[str, str]:        
-        translation = self.client.models.generate_content(
-            model="gemini-2.0-flash-lite",
-            contents=[f"Translate/transliterate this to english",prompt],
-            config={
-                'response_mime_type': 'application/json',
-                'response_schema': Translate,
-            },
-        ) 
-        print(f"translated ==> {translation.parsed.translated_text}\nsrc language ==> {translation.parsed.source_language.value}")
-        result = self.db.query(translation.parsed.translated_text,additional_info=f"Make sure the language is {translation.parsed.source_language.value}")
-
-        
-        return result, translation.parsed.source_language.value
+    async def _translate_fallback(self, text, error) -> Translate:
+        """Reverie NMT for native-script text when the model is unavailable; romanized text is passed on as is."""
+        native = native_language(text)
+        print(f"Model translation failed ({error}), falling back to {'Reverie NMT' if native else 'the original text'}")
+        if native is None:
+            return Translate(translated_text=text, source_language=Language.ENGLISH)
+
+        code, language = native
+        with stage("nmt"):
+            translated = await upstream("nmt").call(asyncio.to_thread, self.nmt.translate, text, code, "en")
+        return Translate(translated_text=translated, source_language=Language(language))
+
+
+    async def _translate_audio(self, audio: bytes, mime_type: str) -> Translate:
+        """Small clips go inline (one model call); larger ones are uploaded from memory and deleted afterwards."""
+        client = await self.get_client()
+        from google.genai import types
+
+        uploaded_file = None
+        if len(audio) < INLINE_AUDIO_BYTES:
+            audio_part = types.Part.from_bytes(data=audio, mime_type=mime_type)
+        else:
+            with stage("audio_upload"):
+                # A fresh buffer per attempt, retries would otherwise upload from the end
+                uploaded_file = await upstream("audio_upload").call(
+                    lambda: client.aio.files.upload(file=io.BytesIO(audio), config={"mime_type": mime_type})
+                )
+            audio_part = uploaded_file
+
+        try:
+            with stage("translate_audio"):
+                translation = await upstream("translate_audio").call(
+                    client.aio.models.generate_content,
+                    model="gemini-2.0-flash-lite",
+                    contents=[f"Translate this to english",audio_part],
+                    config={
+                        'response_mime_type': 'application/json',
+                        'response_schema': Translate,
+                    },
+                )
+        finally:
+            if uploaded_file is not None:
+                try:
+                    await client.aio.files.delete(name=uploaded_file.name)
+                except Exception as e:
+                    print(f"Could not delete uploaded audio {uploaded_file.name}: {e}")
+        return translation.parsed
+
+
+    async def translate_audio(self, audio: bytes, mime_type="audio/mp3", session_id=None, filters=None) -> tuple[str, str, str]:
+        session_id, session = self.sessions.open(session_id)
+        async with self.limit:
+            translation = await self._translate_audio(audio, mime_type)
+            print(f"translated ==> {translation.translated_text}\nsrc language ==> {translation.source_language.value}")
+            result = await self._answer(translation.translated_text, translation.source_language.value, session_id, session, filters)
+
+        return result, translation.source_language.value, session_id
+
+
+    async def translate_audio_stream(self, audio: bytes, mime_type="audio/mp3", session_id=None, filters=None):
+        """Streaming variant of `translate_audio`, see `_stream_answer` for the events."""
+        session_id, session = self.sessions.open(session_id)
+        async with self.limit:
+            translation = await self._translate_audio(audio, mime_type)
+            print(f"translated ==> {translation.translated_text}\nsrc language ==> {translation.source_language.value}")
+            async for event in self._stream_answer(translation.translated_text, translation.source_language.value, session_id, session, filters):
+                yield event
+
+
+    async def detect_and_translate(self, prompt) -> Translate:
+        """Detect the language of `prompt` and render it in English, skipping the model for plain English."""
+        if is_english(prompt):
+            return Translate(translated_text=prompt, source_language=Language.ENGLISH)
+
+        try:
+            with stage("translate"):
+                translation = await upstream("translate").call(
+                    (await self.get_client()).aio.models.generate_content,
+                    model="gemini-2.0-flash-lite",
+                    contents=[f"Translate/transliterate this to english",prompt],
+                    config={
+                        'response_mime_type': 'application/json',
+                        'response_schema': Translate,
+                    },
+                )
+        except Exception as e:
+            return await self._translate_fallback(prompt, e)
+        return translation.parsed
+
+
+    async def _understand(self, prompt, session, filters=None) -> tuple[str, str]:
+        """The query to answer and its language. Follow-ups keep the session's language and are answered untranslated."""
+        if not filters and is_follow_up(session, prompt):
+            print(f"follow-up ==> {prompt}\nsession language ==> {session['language']}")
+            return prompt, session["language"]
+
+        translation = await self.detect_and_translate(prompt)
+        print(f"translated ==> {translation.translated_text}\nsrc language ==> {translation.source_language.value}")
+        return translation.translated_text, translation.source_language.value
+
+
+    def _plan(self, query, session, filters):
+        """
+        Whether `query` is a follow-up and, if not, its search filters: those
+        stated in the query, overridden by the caller's. Caller filters always
+        mean a new search.
+        """
+        if not filters and is_follow_up(session, query):
+            self.sessions.follow_ups += 1
+            return True, None
+
+        filters = {**(query_filters(query) if self.auto_filters else {}), **(filters or {})}
+        if filters:
+            print(f"filters ==> {filters}")
+        return False, filters
+
+
+    async def _answer(self, query, language, session_id, session, filters=None) -> str:
+        follow_up, filters = self._plan(query, session, filters)
+        db = await self.get_db()
+        result = await db.query(query, additional_info=f"Make sure the language is {language}", session=session, follow_up=follow_up, filters=filters)
+        if result is not None:
+            self.sessions.record(session_id, session, language, query, result)
+        return result
+
+
+    async def transliterate_and_query(self, prompt, session_id=None, filters=None) -> tuple[str, str, str]:
+        session_id, session = self.sessions.open(session_id)
+        async with self.limit:
+            query, language = await self._understand(prompt, session, filters)
+            result = await self._answer(query, language, session_id, session, filters)
+
+        return result, language, session_id
+
+
+    async def transliterate_and_query_stream(self, prompt, session_id=None, filters=None):
+        """Streaming variant of `transliterate_and_query`, see `_stream_answer` for the events."""
+        session_id, session = self.sessions.open(session_id)
+        async with self.limit:
+            query, language = await self._understand(prompt, session, filters)
+            async for event in self._stream_answer(query, language, session_id, session, filters):
+                yield event
+
+
+    async def screen(self, profiles):
+        """
+        Answer a batch of enterprise profiles ({"message", "additional_info", "filters"}), yielding
+        {"index", "language", "response" | "error", "group_size"} as each one is ready.
+        See Vector.screen for how retrieval and generation are shared.
+        """
+        async def understand(profile):
+            async with self.limit:
+                return await self.detect_and_translate(profile["message"])
+
+        translations = await asyncio.gather(*(understand(p) for p in profiles), return_exceptions=True)
+        ready = []
+        for i, translation in enumerate(translations):
+            if isinstance(translation, Exception):
+                yield {"index": i, "error": f"Translation failed: {translation}", "group_size": 1}
+            else:
+                ready.append(i)
+
+        queries = [translations[i].translated_text for i in ready]
+        languages = [translations[i].source_language.value for i in ready]
+        filters = [
+            {**(query_filters(query) if self.auto_filters else {}), **(profiles[i].get("filters") or {})}
+            for i, query in zip(ready, queries)
+        ]
+        # Details about the enterprise go to the model with the answer-language
+        # instruction; profiles that differ in them are answered separately
+        additional_infos = [
+            f"Make sure the language is {language}"
+            + (f"\nAbout the enterprise: {profiles[i]['additional_info']}" if profiles[i].get("additional_info") else "")
+            for i, language in zip(ready, languages)
+        ]
+        db = await self.get_db()
+        async for event in db.screen(
+            queries,
+            additional_infos,
+            filters,
+            concurrency=self.batch_concurrency,
+            group_max=self.batch_group_max,
+        ):
+            position = event["index"]
+            yield {**event, "index": ready[position], "language": languages[position]}
+
+
+    async def _stream_answer(self, query, language, session_id, session, filters=None):
+        """Yield a `language` event (with the session id) first, then `token` events as the answer is generated, then `done`."""
+        yield {"type": "language", "language": language, "session_id": session_id}
+
+        follow_up, filters = self._plan(query, session, filters)
+        db = await self.get_db()
+        parts = []
+        async for text in db.query_stream(query, additional_info=f"Make sure the language is {language}", session=session, follow_up=follow_up, filters=filters):
+            parts.append(text)
+            yield {"type": "token", "text": text}
+
+        if parts:
+            self.sessions.record(session_id, session, language, query, "".join(parts))
+        else:
+            yield {"type": "error", "error": "No response generated"}
+        yield {"type": "done"}
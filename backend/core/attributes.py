@@ -0,0 +1,186 @@
+import re
+
+import numpy as np
+
+# Bump when the rules change so msme-rag.py re-tags existing chunks
+ATTRIBUTES_VERSION = 3
+
+STATES = [
+    "andhra pradesh", "arunachal pradesh", "assam", "bihar", "chhattisgarh", "goa", "gujarat", "haryana",
+    "himachal pradesh", "jharkhand", "karnataka", "kerala", "madhya pradesh", "maharashtra", "manipur",
+    "meghalaya", "mizoram", "nagaland", "odisha", "punjab", "rajasthan", "sikkim", "tamil nadu", "telangana",
+    "tripura", "uttar pradesh", "uttarakhand", "west bengal", "delhi", "jammu and kashmir", "ladakh",
+    "puducherry", "chandigarh", "andaman and nicobar", "lakshadweep", "dadra and nagar haveli",
+]
+
+SECTORS = {
+    "manufacturing": ["manufactur", "factory", "factories", "industrial unit", "production unit"],
+    "agri_food": ["food processing", "agro", "agri", "dairy", "fisher", "poultry", "horticulture", "farm"],
+    "textiles": ["textile", "handloom", "weaver", "weaving", "apparel", "garment", "khadi", "silk"],
+    "handicrafts": ["handicraft", "artisan", "craftsm", "coir", "bamboo"],
+    "technology": ["software", "information technology", "digital", "startup", "start-up", "innovation", "incubat"],
+    "services": ["service sector", "service enterprise", "retail", "trading", "tourism", "logistics"],
+    "export": ["export"],
+}
+
+TARGET_GROUPS = {
+    "women": [r"wom[ae]n", r"female", r"mahila"],
+    "sc_st": [r"scheduled castes?", r"scheduled tribes?", r"sc\s*/\s*st", r"sc\s*-\s*st", r"sc\s*&\s*st", r"sc\s+and\s+st"],
+    "minority": [r"minorit(?:y|ies)"],
+}
+
+SIZES = ("micro", "small", "medium")
+
+GROUP_RES = {group: re.compile(r"\b(?:" + "|".join(patterns) + r")", re.IGNORECASE) for group, patterns in TARGET_GROUPS.items()}
+# Whole words only: "goa" must not match "goals" or "goat", nor "assam" "assamese"
+STATE_RES = {state: re.compile(rf"\b{state}\b") for state in STATES}
+SIZE_RES = {size: re.compile(rf"\b{size}\b", re.IGNORECASE) for size in SIZES}
+CENTRAL_RE = re.compile(r"government of india|ministry of|central sector|centrally sponsored|govt\.? of india", re.IGNORECASE)
+
+# Filters accepted from callers, with the values each one allows
+FILTERS = {
+    "scope": ("central", "state"),
+    "state": tuple(STATES),
+    "sector": tuple(SECTORS),
+    "target_group": tuple(TARGET_GROUPS),
+    "size": SIZES,
+    "has_application": (True, False),
+}
+
+
+def _sectors(text):
+    """Sectors with a keyword in lowercased `text`, in SECTORS order."""
+    return [sector for sector, words in SECTORS.items() if any(word in text for word in words)]
+
+
+def _states(text):
+    """Mentions per state in lowercased `text`."""
+    counts = {state: len(pattern.findall(text)) for state, pattern in STATE_RES.items()}
+    return {state: count for state, count in counts.items() if count}
+
+
+def extract_attributes(content: str) -> dict:
+    """
+    Scalar metadata for one scheme chunk, from keyword rules over its text.
+
+    scope/state: "state" plus the state name for state-government schemes,
+    "central" and "" otherwise. sector_<sector>: the chunk mentions that entry
+    of SECTORS (a scheme often serves several); sector_general when it
+    mentions none. for_<group>: the scheme mentions that target group;
+    open_to_all when it mentions none. size_<size>: enterprise sizes named
+    (all True when none is). has_application: the chunk carries application
+    steps.
+    """
+    text = content.lower()
+    states = _states(text)
+    state = max(states, key=states.get) if states else ""
+    is_state = bool(state) and not CENTRAL_RE.search(content) and (
+        f"government of {state}" in text or states[state] >= 2
+    )
+
+    attributes = {
+        "scope": "state" if is_state else "central",
+        "state": state if is_state else "",
+        "has_application": "How to Apply" in content,
+    }
+    sectors = _sectors(text)
+    for sector in SECTORS:
+        attributes[f"sector_{sector}"] = sector in sectors
+    attributes["sector_general"] = not sectors
+    for group, pattern in GROUP_RES.items():
+        attributes[f"for_{group}"] = bool(pattern.search(content))
+    attributes["open_to_all"] = not any(attributes[f"for_{group}"] for group in TARGET_GROUPS)
+
+    sizes = {size: bool(pattern.search(content)) for size, pattern in SIZE_RES.items()}
+    for size in SIZES:
+        attributes[f"size_{size}"] = sizes[size] or not any(sizes.values())
+    return attributes
+
+
+def query_filters(query: str) -> dict:
+    """
+    Filters stated outright in an English query ("for women in Kerala");
+    unmentioned ones are left out. A query naming several sectors gets a list
+    of them, matched by schemes in any one.
+    """
+    text = query.lower()
+    filters = {}
+    states = _states(text)
+    if states:
+        filters["state"] = max(states, key=states.get)
+    groups = [group for group, pattern in GROUP_RES.items() if pattern.search(query)]
+    if len(groups) == 1:
+        filters["target_group"] = groups[0]
+    sizes = [size for size, pattern in SIZE_RES.items() if pattern.search(query)]
+    if len(sizes) == 1:
+        filters["size"] = sizes[0]
+    sectors = _sectors(text)
+    if sectors:
+        filters["sector"] = sectors[0] if len(sectors) == 1 else sectors
+    return filters
+
+
+def parse_filters(filters) -> dict:
+    """Validate caller-supplied filters; raises ValueError naming the offending key."""
+    if not isinstance(filters, dict):
+        raise ValueError("filters must be an object")
+    parsed = {}
+    for key, value in filters.items():
+        if key not in FILTERS:
+            raise ValueError(f"Unknown filter {key!r}, expected one of {sorted(FILTERS)}")
+        if isinstance(value, str):
+            value = value.strip().lower().replace("-", "_") if key != "state" else value.strip().lower()
+        if value not in FILTERS[key]:
+            raise ValueError(f"Unsupported value {value!r} for filter {key!r}")
+        parsed[key] = value
+    return parsed
+
+
+def to_where(filters: dict):
+    """
+    Chroma `where` clause for `filters`, or None. Central schemes match any
+    state; a sector (or list of sectors) matches schemes tagged with any of
+    them and general ones.
+    """
+    clauses = []
+    for key, value in sorted(filters.items()):
+        if key == "state":
+            clauses.append({"$or": [{"scope": "central"}, {"state": value}]})
+        elif key == "sector":
+            sectors = value if isinstance(value, list) else [value]
+            clauses.append({"$or": [{f"sector_{sector}": True} for sector in sectors] + [{"sector_general": True}]})
+        elif key == "target_group":
+            clauses.append({"$or": [{f"for_{value}": True}, {"open_to_all": True}]})
+        elif key == "size":
+            clauses.append({f"size_{value}": True})
+        else:
+            clauses.append({key: value})
+    if not clauses:
+        return None
+    return clauses[0] if len(clauses) == 1 else {"$and": clauses}
+
+
+def evaluate(where, get):
+    """
+    Evaluate the subset of Chroma's `where` syntax that `to_where` produces.
+
+    `get(key)` returns a value or a NumPy column, so this works for a single
+    metadata dict as well as for whole columns at once.
+    """
+    if "$and" in where:
+        return np.logical_and.reduce([evaluate(clause, get) for clause in where["$and"]])
+    if "$or" in where:
+        return np.logical_or.reduce([evaluate(clause, get) for clause in where["$or"]])
+    (key, condition), = where.items()
+    if isinstance(condition, dict):
+        (op, value), = condition.items()
+        if op == "$in":
+            return np.isin(get(key), value)
+        if op != "$eq":
+            raise ValueError(f"Unsupported where operator {op}")
+        condition = value
+    return np.asarray(get(key)) == condition
+
+
+def matches(where, metadata) -> bool:
+    return bool(evaluate(where, lambda key: (metadata or {}).get(key)))
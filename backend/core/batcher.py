@@ -0,0 +1,69 @@
+import asyncio
+
+
+class EmbeddingBatcher():
+    """
+    Coalesces concurrent single-text embedding requests into batched calls.
+
+    Requests arriving within `window_ms` of the first pending one (or until
+    `max_batch` texts are waiting) are sent as one `embed_many(texts)` call and
+    each caller gets its own vector back. Identical texts in a batch are embedded
+    once. A window of 0 sends every request on its own.
+    """
+    def __init__(self, embed_many, window_ms=5, max_batch=32):
+        self.embed_many = embed_many
+        self.window = window_ms / 1000
+        self.max_batch = max_batch
+        self.pending = []
+        self.timer = None
+        # Keeps in-flight send tasks referenced until they finish
+        self.tasks = set()
+        self.batches = 0
+        self.items = 0
+
+    async def embed(self, text):
+        if self.window <= 0:
+            self.batches += 1
+            self.items += 1
+            return (await self.embed_many([text]))[0]
+
+        future = asyncio.get_running_loop().create_future()
+        self.pending.append((text, future))
+        if len(self.pending) >= self.max_batch:
+            self._flush()
+        elif self.timer is None:
+            self.timer = asyncio.get_running_loop().call_later(self.window, self._flush)
+        return await future
+
+    def _flush(self):
+        if self.timer is not None:
+            self.timer.cancel()
+            self.timer = None
+        batch, self.pending = self.pending, []
+        if batch:
+            task = asyncio.create_task(self._send(batch))
+            self.tasks.add(task)
+            task.add_done_callback(self.tasks.discard)
+
+    async def _send(self, batch):
+        texts = list(dict.fromkeys(text for text, _ in batch))
+        self.batches += 1
+        self.items += len(batch)
+        try:
+            vectors = dict(zip(texts, await self.embed_many(texts)))
+        except Exception as e:
+            for _, future in batch:
+                if not future.done():
+                    future.set_exception(e)
+            return
+
+        for text, future in batch:
+            if not future.done():
+                future.set_result(vectors[text])
+
+    def stats(self):
+        return {
+            "batches": self.batches,
+            "items": self.items,
+            "avg_batch_size": self.items / self.batches if self.batches else 0.0,
+        }
@@ -0,0 +1,196 @@
+import json
+import os
+import re
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+
+def normalize(text: str) -> str:
+    """Collapse case, whitespace and trailing punctuation so trivial rephrasings share a key."""
+    text = re.sub(r"\s+", " ", text.strip().lower())
+    return text.strip(" .?!")
+
+
+class EmbeddingCache():
+    """
+    Size-bounded LRU cache of query embeddings keyed on normalized query text.
+
+    If `path` is given the cache is loaded from it on start-up and written back
+    by `save()`, so it survives restarts. Every `persist_every` new entries a
+    copy is also written from a background thread, so `put` never blocks the
+    event loop on disk. The file holds the keys and a float32 matrix (.npz).
+    """
+    def __init__(self, max_size=1024, path=None, persist_every=50):
+        self.max_size = max_size
+        self.path = path
+        self.persist_every = persist_every
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self._dirty = 0
+        self._lock = threading.Lock()
+        self._saver = ThreadPoolExecutor(max_workers=1, thread_name_prefix="embed-cache")
+        self._saving = None
+
+        if self.path and os.path.exists(self.path):
+            self.load()
+
+    def get(self, text):
+        key = normalize(text)
+        embedding = self.entries.get(key)
+        if embedding is None:
+            self.misses += 1
+            return None
+
+        self.entries.move_to_end(key)
+        self.hits += 1
+        return embedding.tolist()
+
+    def put(self, text, embedding):
+        key = normalize(text)
+        # Held as float32 arrays so a snapshot for saving is a cheap stack
+        self.entries[key] = np.asarray(embedding, dtype=np.float32)
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.max_size:
+            self.entries.popitem(last=False)
+
+        self._dirty += 1
+        if self.path and self._dirty >= self.persist_every and (self._saving is None or self._saving.done()):
+            # Entries are never mutated once stored, so a shallow copy is a consistent snapshot
+            self._saving = self._saver.submit(self._write, list(self.entries.items()))
+            self._dirty = 0
+
+    def stats(self):
+        total = self.hits + self.misses
+        return {
+            "size": len(self.entries),
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / total if total else 0.0,
+        }
+
+    def load(self):
+        try:
+            with open(self.path, "rb") as f:
+                # .npz files are zip archives
+                is_npz = f.read(4) == b"PK\x03\x04"
+                f.seek(0)
+                if is_npz:
+                    with np.load(f, allow_pickle=False) as data:
+                        items = list(zip(data["keys"].tolist(), data["embeddings"]))
+                else:
+                    # Caches written before the .npz format
+                    items = json.load(f)
+        except (OSError, ValueError, KeyError) as e:
+            print(f"Could not load embedding cache from {self.path}: {e}")
+            return
+
+        # Stored oldest-first, so replaying keeps the LRU order intact
+        for key, embedding in items[-self.max_size:]:
+            self.entries[key] = np.asarray(embedding, dtype=np.float32)
+
+    def save(self):
+        """Write the cache now, after any background write in progress; used on shutdown."""
+        if not self.path:
+            return
+        self._write(list(self.entries.items()))
+        self._dirty = 0
+
+    def _write(self, items):
+        keys = np.array([key for key, _ in items], dtype=str)
+        embeddings = np.stack([embedding for _, embedding in items]) if items else np.zeros((0, 0), dtype=np.float32)
+        tmp_path = f"{self.path}.tmp"
+        with self._lock:
+            try:
+                with open(tmp_path, "wb") as f:
+                    np.savez(f, keys=keys, embeddings=embeddings)
+                os.replace(tmp_path, self.path)
+            except OSError as e:
+                print(f"Could not save embedding cache to {self.path}: {e}")
+
+
+class SemanticCache():
+    """
+    Answer cache keyed on query-embedding similarity.
+
+    A lookup hits when a cached query in the same `scope` (the target-language
+    instruction) has cosine similarity >= `threshold` and has not expired.
+    `version_fn` returns an identifier of the current index build; when it
+    changes every entry is dropped, so answers never outlive a rebuild.
+    """
+    def __init__(self, max_size=512, threshold=0.95, ttl=3600, version_fn=None):
+        self.max_size = max_size
+        self.threshold = threshold
+        self.ttl = ttl
+        self.version_fn = version_fn
+        self.version = version_fn() if version_fn else None
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self._next_id = 0
+
+    def _check_version(self):
+        if not self.version_fn:
+            return
+        version = self.version_fn()
+        if version != self.version:
+            print(f"Index build changed ({self.version} -> {version}), clearing answer cache")
+            self.entries.clear()
+            self.version = version
+
+    def _evict_expired(self, now):
+        expired = [key for key, entry in self.entries.items() if entry["expires_at"] <= now]
+        for key in expired:
+            del self.entries[key]
+
+    def get(self, embedding, scope=None):
+        self._check_version()
+        now = time.monotonic()
+        self._evict_expired(now)
+
+        candidates = [(key, entry) for key, entry in self.entries.items() if entry["scope"] == scope]
+        if not candidates:
+            self.misses += 1
+            return None
+
+        query = np.array(embedding, dtype=np.float32)
+        query /= np.linalg.norm(query) or 1.0
+        matrix = np.stack([entry["embedding"] for _, entry in candidates])
+        scores = matrix @ query
+        best = int(np.argmax(scores))
+        if scores[best] < self.threshold:
+            self.misses += 1
+            return None
+
+        key, entry = candidates[best]
+        self.entries.move_to_end(key)
+        self.hits += 1
+        return entry["answer"]
+
+    def put(self, embedding, answer, scope=None):
+        self._check_version()
+        vector = np.array(embedding, dtype=np.float32)
+        vector /= np.linalg.norm(vector) or 1.0
+
+        self.entries[self._next_id] = {
+            "embedding": vector,
+            "scope": scope,
+            "answer": answer,
+            "expires_at": time.monotonic() + self.ttl,
+        }
+        self._next_id += 1
+        while len(self.entries) > self.max_size:
+            self.entries.popitem(last=False)
+
+    def stats(self):
+        total = self.hits + self.misses
+        return {
+            "size": len(self.entries),
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / total if total else 0.0,
+        }
@@ -0,0 +1,52 @@
+import os
+
+import numpy as np
+
+
+class StringColumn():
+    """
+    Read-only sequence of strings stored back to back in `<name>.bin`, with row
+    boundaries in `<name>.offsets.npy`. Both files are memory-mapped, so rows are
+    only decoded when read and every process opening the same files shares them.
+    """
+    def __init__(self, path, name, decode=None):
+        self.offsets = np.load(os.path.join(path, f"{name}.offsets.npy"), mmap_mode="r")
+        blob_path = os.path.join(path, f"{name}.bin")
+        # np.memmap refuses empty files
+        if os.path.getsize(blob_path):
+            self.blob = np.memmap(blob_path, dtype=np.uint8, mode="r")
+        else:
+            self.blob = np.zeros(0, dtype=np.uint8)
+        self.decode = decode
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def __getitem__(self, row):
+        value = self.blob[self.offsets[row]:self.offsets[row + 1]].tobytes().decode("utf-8")
+        return self.decode(value) if self.decode else value
+
+    @staticmethod
+    def write(path, name, values):
+        writer = StringColumnWriter(path, name)
+        for value in values:
+            writer.append(value)
+        writer.close()
+
+
+class StringColumnWriter():
+    """Writes a StringColumn row by row; only the row offsets are kept in memory."""
+    def __init__(self, path, name):
+        self.path = path
+        self.name = name
+        self.file = open(os.path.join(path, f"{name}.bin"), "wb")
+        self.offsets = [0]
+
+    def append(self, value):
+        encoded = value.encode("utf-8")
+        self.file.write(encoded)
+        self.offsets.append(self.offsets[-1] + len(encoded))
+
+    def close(self):
+        self.file.close()
+        np.save(os.path.join(self.path, f"{self.name}.offsets.npy"), np.array(self.offsets, dtype=np.int64))
@@ -0,0 +1,104 @@
+import re
+
+
+def estimate_tokens(text: str) -> int:
+    """Rough token count (about four characters per token for English), good enough for budgeting."""
+    return len(text) // 4 + 1
+
+
+def split_passages(content: str, max_chars=1500):
+    """Split a scheme chunk into paragraph-aligned passages of at most `max_chars`."""
+    passages = []
+    current = ""
+    for paragraph in re.split(r'\n\s*\n', content):
+        paragraph = paragraph.strip()
+        if not paragraph:
+            continue
+        # Hard-wrap paragraphs that are longer than a passage on their own
+        while len(paragraph) > max_chars:
+            cut = paragraph.rfind(" ", 0, max_chars)
+            cut = cut if cut > 0 else max_chars
+            if current:
+                passages.append(current)
+                current = ""
+            passages.append(paragraph[:cut].strip())
+            paragraph = paragraph[cut:].strip()
+        if current and len(current) + len(paragraph) + 2 > max_chars:
+            passages.append(current)
+            current = ""
+        current = f"{current}\n\n{paragraph}" if current else paragraph
+    if current:
+        passages.append(current)
+    return passages
+
+
+class ContextBuilder():
+    """
+    Turns retrieved passages into the scheme section of the prompt under a token budget.
+
+    Passages are taken best-first until the budget is spent, at most `max_schemes`
+    parent schemes are included, and passages of the same scheme are grouped
+    under its title in document order. Records without a `parent` (indexes built
+    before passages existed) are treated as single-passage schemes and truncated
+    to fit.
+    """
+    def __init__(self, token_budget=2000, max_schemes=3):
+        self.token_budget = token_budget
+        self.max_schemes = max_schemes
+        self.prompts = 0
+        self.retrieved_tokens = 0
+        self.context_tokens = 0
+
+    def build(self, results):
+        groups = {}
+        used = 0
+        retrieved = 0
+        for cid, doc, meta in zip(results["ids"][0], results["documents"][0], results["metadatas"][0]):
+            meta = meta or {}
+            tokens = estimate_tokens(doc)
+            retrieved += tokens
+            parent = meta.get("parent", cid)
+            if parent not in groups and len(groups) >= self.max_schemes:
+                continue
+
+            remaining = self.token_budget - used
+            if tokens > remaining:
+                if used:
+                    continue
+                # Nothing selected yet: keep a truncated prefix rather than nothing
+                doc = doc[:remaining * 4]
+                tokens = estimate_tokens(doc)
+
+            group = groups.setdefault(parent, {"meta": meta, "passages": []})
+            group["passages"].append((meta.get("passage", 0), doc))
+            used += tokens
+
+        self.prompts += 1
+        self.retrieved_tokens += retrieved
+        self.context_tokens += used
+        print(f"context ==> {used} of {retrieved} retrieved tokens across {len(groups)} schemes")
+
+        sections = []
+        for group in groups.values():
+            meta = group["meta"]
+            body = "\n".join(doc for _, doc in sorted(group["passages"], key=lambda p: p[0]))
+            eligibility = meta.get("eligibility", "Please refer to official sites for eligibility details.")
+            description = meta.get("description", "Description not available. Please refer to official sites.")
+            application = "Includes application details" if meta.get("has_application") else "Please refer to official sites for application instructions."
+            # Later passages do not repeat the scheme name, so put it back in front
+            title = meta.get("title")
+            if title and not body.startswith(title):
+                body = f"{title}\n{body}"
+            sections.append(
+                f"• {body}\n  - Eligibility: {eligibility}\n  - Description: {description}\n  - Application Info: {application}"
+            )
+        return "\n".join(sections)
+
+    def stats(self):
+        return {
+            "prompts": self.prompts,
+            "retrieved_tokens": self.retrieved_tokens,
+            "context_tokens": self.context_tokens,
+            "avg_retrieved_tokens": self.retrieved_tokens / self.prompts if self.prompts else 0.0,
+            "avg_context_tokens": self.context_tokens / self.prompts if self.prompts else 0.0,
+        }
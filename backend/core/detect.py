@@ -0,0 +1,110 @@
+import re
+
+# Unicode blocks for the scripts behind the Language enum
+SCRIPT_RANGES = {
+    "devanagari": (0x0900, 0x097F),  # hindi, marathi
+    "bengali": (0x0980, 0x09FF),
+    "gujarati": (0x0A80, 0x0AFF),
+    "tamil": (0x0B80, 0x0BFF),
+    "telugu": (0x0C00, 0x0C7F),
+    "kannada": (0x0C80, 0x0CFF),
+    "malayalam": (0x0D00, 0x0D7F),
+    "arabic": (0x0600, 0x06FF),  # urdu
+}
+
+# Frequent words of romanized Indian languages that do not occur in English queries
+ROMANIZED_MARKERS = {
+    # hindi / urdu
+    "hai", "hain", "kya", "kaise", "kaun", "kon", "mujhe", "mera", "meri", "mere", "ke", "ki", "ka",
+    "liye", "keliye", "nahi", "nahin", "aur", "chahiye", "batao", "bataiye", "bataen", "karna",
+    "karo", "hoon", "hum", "yojana", "mein", "kuch", "konsi", "kaunsi", "milega", "sakta", "sakti",
+    # tamil
+    "enna", "epdi", "eppadi", "naan", "enakku", "irukku", "venum", "vendum", "pathi", "sollunga",
+    "thittam", "yenna",
+    # telugu
+    "emi", "enti", "ela", "naaku", "kavali", "cheppandi", "gurinchi", "undi", "ledu",
+    # bengali
+    "ami", "amar", "kivabe", "bolun", "jonno", "prokolpo", "ache", "korte",
+    # marathi
+    "mala", "kasa", "kay", "ahe", "sathi", "pahije", "sanga", "kashi",
+    # gujarati
+    "mane", "kem", "che", "chhe", "mate", "joie", "yojna",
+    # kannada
+    "nanage", "hege", "beku", "yojane", "bagge", "heli",
+    # malayalam
+    "enikku", "engane", "venam", "patti", "parayu", "aanu",
+}
+
+ENGLISH_MARKERS = {
+    "the", "a", "an", "for", "of", "to", "in", "on", "is", "are", "what", "which", "how", "who",
+    "can", "i", "my", "me", "we", "our", "and", "or", "with", "about", "there", "any", "do", "does",
+    "tell", "scheme", "schemes", "loan", "loans", "eligibility", "eligible", "apply", "business",
+}
+
+WORD_RE = re.compile(r"[a-z]+")
+
+
+def script_counts(text: str) -> dict:
+    """Count letters per script; Latin letters are reported under "latin"."""
+    counts = {}
+    for ch in text:
+        if not ch.isalpha():
+            continue
+        code = ord(ch)
+        if code < 0x0250:
+            script = "latin"
+        else:
+            script = next((name for name, (lo, hi) in SCRIPT_RANGES.items() if lo <= code <= hi), "other")
+        counts[script] = counts.get(script, 0) + 1
+    return counts
+
+
+def is_english(text: str, min_latin_ratio=0.95) -> bool:
+    """
+    True only when `text` is confidently plain English: written in Latin script
+    with no romanized Indian-language words. Anything else is left to the model.
+    """
+    counts = script_counts(text)
+    letters = sum(counts.values())
+    if not letters or counts.get("latin", 0) / letters < min_latin_ratio:
+        return False
+
+    words = WORD_RE.findall(text.lower())
+    if any(word in ROMANIZED_MARKERS for word in words):
+        return False
+
+    # Very short inputs ("Mudra loan") rarely carry function words
+    return len(words) <= 3 or any(word in ENGLISH_MARKERS for word in words)
+
+
+# Reverie NMT code and Language value per native script, for translating without the model.
+# For scripts in SHARED_SCRIPTS this is only the most common of their languages.
+SCRIPT_LANGUAGES = {
+    "devanagari": ("hi", "hindi"),
+    "bengali": ("bn", "bengali"),
+    "gujarati": ("gu", "gujarati"),
+    "tamil": ("ta", "tamil"),
+    "telugu": ("te", "telugu"),
+    "kannada": ("kn", "kanada"),
+    "malayalam": ("ml", "malayalam"),
+    "arabic": ("ur", "urdu"),
+}
+# Devanagari is also Marathi (and Nepali, Konkani), Bengali script also
+# Assamese, Arabic script also Kashmiri and Sindhi
+SHARED_SCRIPTS = {"devanagari", "bengali", "arabic"}
+
+
+def native_language(text: str, unambiguous=False):
+    """
+    (Reverie code, Language value) of the dominant Indian script in `text`, or
+    None for Latin text. With `unambiguous`, also None when that script is
+    written for more than one language and the text needs the model.
+    """
+    counts = script_counts(text)
+    scripts = [script for script in counts if script in SCRIPT_LANGUAGES]
+    if not scripts:
+        return None
+    script = max(scripts, key=counts.get)
+    if unambiguous and script in SHARED_SCRIPTS:
+        return None
+    return SCRIPT_LANGUAGES[script]
@@ -0,0 +1,422 @@
+import json
+import os
+import shutil
+import sys
+import threading
+import time
+
+import numpy as np
+
+from .attributes import evaluate
+from .columns import StringColumn, StringColumnWriter
+from .lexical import LexicalIndex, LexicalWriter
+
+COLLECTION = "msme_schemes"
+# Output size of models/embedding-001
+EMBEDDING_DIM = 768
+DTYPES = ("float32", "float16", "int8")
+# Rows widened to float32 at a time when scoring a float16/int8 matrix; small
+# enough to stay in cache, so an int8 search costs about as much as float32
+SCORE_BLOCK_ROWS = 512
+# Rows read from Chroma per request when exporting
+PAGE_ROWS = 1000
+# Published builds live in <db>/snapshots/<build id>; CURRENT names the live one
+SNAPSHOTS = "snapshots"
+CURRENT = "CURRENT"
+
+
+class ChromaIndex():
+    """Retrieval backed by the persistent Chroma collection (HNSW)."""
+    def __init__(self, path="./msme_db"):
+        import chromadb
+
+        self.client = chromadb.PersistentClient(path=path)
+        self.db = self.client.get_collection(COLLECTION)
+
+    def search(self, embedding, n_results=3, where=None):
+        return self.db.query(
+            query_embeddings=embedding,
+            n_results=n_results,
+            where=where,
+            include=["documents", "metadatas", "distances"]
+        )
+
+    def search_many(self, embeddings, n_results=3, where=None):
+        """One Chroma query for several embeddings; results are nested per embedding."""
+        return self.db.query(
+            query_embeddings=embeddings,
+            n_results=n_results,
+            where=where,
+            include=["documents", "metadatas", "distances"]
+        )
+
+    def get(self, ids):
+        """Fetch chunks by id, in the order given, using the same layout as `search`."""
+        data = self.db.get(ids=ids, include=["documents", "metadatas"])
+        rows = {cid: (doc, meta) for cid, doc, meta in zip(data["ids"], data["documents"], data["metadatas"])}
+        ids = [cid for cid in ids if cid in rows]
+        return {
+            "ids": [ids],
+            "documents": [[rows[cid][0] for cid in ids]],
+            "metadatas": [[rows[cid][1] for cid in ids]],
+        }
+
+    def count(self):
+        return self.db.count()
+
+    def warm(self):
+        # Forces the HNSW segment and its SQLite metadata to be loaded
+        if self.count():
+            self.search([0.0] * (EMBEDDING_DIM - 1) + [1.0], n_results=1)
+
+
+class NumpyIndex():
+    """
+    Exact cosine search over an exported snapshot of the collection.
+
+    The embedding matrix is memory-mapped from `embeddings.npy` (float32, float16
+    or int8 with per-row scales in `scales.npy`); documents and metadata are
+    memory-mapped string columns (see StringColumn). Results use Chroma's
+    nested-list layout so callers can switch backends freely; distances are
+    cosine distances.
+    """
+    def __init__(self, path):
+        self.path = path
+        self.matrix = np.load(os.path.join(path, "embeddings.npy"), mmap_mode="r")
+        scales_path = os.path.join(path, "scales.npy")
+        self.scales = np.load(scales_path, mmap_mode="r") if os.path.exists(scales_path) else None
+        store_path = os.path.join(path, "store.json")
+        if os.path.exists(store_path):
+            # Exports written before the columnar layout
+            with open(store_path, "r", encoding="utf-8") as f:
+                store = json.load(f)
+            self.ids = store["ids"]
+            self.documents = store["documents"]
+            self.metadatas = store["metadatas"]
+        else:
+            self.ids = list(StringColumn(path, "ids"))
+            self.documents = StringColumn(path, "documents")
+            self.metadatas = StringColumn(path, "metadatas", decode=json.loads)
+        self.rows = {cid: row for row, cid in enumerate(self.ids)}
+        # Metadata values by key, decoded on the first filtered search that needs them
+        self.columns = {}
+
+    def column(self, key):
+        if key not in self.columns:
+            self.columns[key] = np.array([(self.metadatas[i] or {}).get(key) for i in range(len(self.ids))], dtype=object)
+        return self.columns[key]
+
+    def search(self, embedding, n_results=3, where=None):
+        return self.search_many([embedding], n_results, where)
+
+    def search_many(self, embeddings, n_results=3, where=None):
+        """Top `n_results` for each embedding, with one matrix product for all of them."""
+        queries = np.array(embeddings, dtype=np.float32).reshape(len(embeddings), -1)
+        norms = np.linalg.norm(queries, axis=1, keepdims=True)
+        queries /= np.where(norms == 0, 1.0, norms)
+
+        scores = self._scores(queries)
+        if self.scales is not None:
+            scores *= np.asarray(self.scales)[:, None]
+
+        candidates = len(scores)
+        if where is not None and candidates:
+            mask = evaluate(where, self.column)
+            scores[~mask] = -np.inf
+            candidates = int(mask.sum())
+
+        k = min(n_results, candidates)
+        results = {"ids": [], "documents": [], "metadatas": [], "distances": []}
+        for column in scores.T:
+            top = np.argpartition(-column, k - 1)[:k] if k else np.array([], dtype=int)
+            top = top[np.argsort(-column[top])]
+            results["ids"].append([self.ids[i] for i in top])
+            results["documents"].append([self.documents[i] for i in top])
+            results["metadatas"].append([self.metadatas[i] for i in top])
+            results["distances"].append([float(1 - column[i]) for i in top])
+        return results
+
+    def _scores(self, queries):
+        if self.matrix.dtype == np.float32:
+            return self.matrix @ queries.T
+        # NumPy has no fast float16/int8 matmul. Widening the whole matrix would
+        # copy it into every worker on every query, so it is done a block at a
+        # time into one small buffer (float16 widening is still the slow part;
+        # prefer int8 for compressed snapshots).
+        rows = len(self.matrix)
+        scores = np.empty((rows, len(queries)), dtype=np.float32)
+        block = np.empty((min(SCORE_BLOCK_ROWS, rows), self.matrix.shape[1]), dtype=np.float32)
+        for start in range(0, rows, SCORE_BLOCK_ROWS):
+            stop = min(start + SCORE_BLOCK_ROWS, rows)
+            widened = block[:stop - start]
+            np.copyto(widened, self.matrix[start:stop], casting="unsafe")
+            np.matmul(widened, queries.T, out=scores[start:stop])
+        return scores
+
+    def get(self, ids):
+        rows = [self.rows[cid] for cid in ids if cid in self.rows]
+        return {
+            "ids": [[self.ids[i] for i in rows]],
+            "documents": [[self.documents[i] for i in rows]],
+            "metadatas": [[self.metadatas[i] for i in rows]],
+        }
+
+    def count(self):
+        return len(self.ids)
+
+    def warm(self):
+        # Touches every page of the memory-mapped matrix
+        if self.count():
+            self.search(np.ones(self.matrix.shape[1], dtype=np.float32), n_results=1)
+
+
+def read_current(path="./msme_db"):
+    """Build id of the live snapshot under `path`, or None if nothing has been published."""
+    try:
+        with open(os.path.join(path, SNAPSHOTS, CURRENT), "r", encoding="utf-8") as f:
+            return f.read().strip() or None
+    except OSError:
+        return None
+
+
+class SnapshotIndex():
+    """
+    NumpyIndex over the live published snapshot, following new builds.
+
+    msme-rag.py exports every build into its own immutable directory under
+    `<path>/snapshots` and then atomically rewrites the CURRENT pointer. All
+    files are memory-mapped read-only, so any number of worker processes share
+    one copy through the page cache instead of each opening Chroma. The pointer
+    is re-read at most every `check_interval` seconds; a new build is opened
+    next to the old one and searches already running finish on the old one.
+
+    The snapshot's BM25 postings (see LexicalIndex) are swapped in with it.
+    With `vectors=False` only they are followed, for the Chroma backend, and
+    having nothing published yet is not an error.
+    """
+    def __init__(self, path="./msme_db", check_interval=5.0, vectors=True):
+        self.path = path
+        self.check_interval = check_interval
+        self.vectors = vectors
+        self.lock = threading.Lock()
+        self.checked = 0.0
+        self.version = None
+        self.active = None
+        self.lexical = None
+        self._refresh()
+        if vectors and self.active is None:
+            raise FileNotFoundError(f"No published snapshot in {os.path.join(path, SNAPSHOTS)}, run `python msme-rag.py index`")
+
+    def current(self):
+        """The live NumpyIndex; this may open a new build, so call it from a worker thread, not the event loop."""
+        if time.monotonic() - self.checked >= self.check_interval:
+            self._refresh()
+        return self.active
+
+    def current_lexical(self):
+        """The live LexicalIndex (None if the build has none), following new builds like `current`."""
+        self.current()
+        return self.lexical
+
+    def _refresh(self):
+        with self.lock:
+            self.checked = time.monotonic()
+            version = read_current(self.path)
+            if version is None or version == self.version:
+                return
+            snapshot_dir = os.path.join(self.path, SNAPSHOTS, version)
+            try:
+                active = NumpyIndex(snapshot_dir) if self.vectors else None
+                lexical = LexicalIndex.load(snapshot_dir)
+            except OSError as e:
+                # Pruned or half-written; keep serving the snapshot we have
+                print(f"Could not open snapshot {version}: {e}")
+                return
+            self.active, self.lexical = active, lexical
+            self.version = version
+            print(f"Serving index snapshot {version}" + (f" ({active.count()} chunks)" if active is not None else ""))
+
+    def search(self, embedding, n_results=3, where=None):
+        return self.current().search(embedding, n_results, where)
+
+    def search_many(self, embeddings, n_results=3, where=None):
+        return self.current().search_many(embeddings, n_results, where)
+
+    def get(self, ids):
+        return self.current().get(ids)
+
+    def count(self):
+        return self.current().count()
+
+    def warm(self):
+        self.current().warm()
+
+
+def make_index(backend=None, path="./msme_db"):
+    """
+    "chroma" opens the persistent collection. "numpy" (or "snapshot") serves the
+    published snapshots, or the fixed export in NUMPY_INDEX_PATH when set.
+    """
+    backend = backend or os.getenv("RETRIEVAL_BACKEND", "chroma")
+    if backend in ("numpy", "snapshot"):
+        fixed_path = os.getenv("NUMPY_INDEX_PATH")
+        if fixed_path:
+            return NumpyIndex(fixed_path)
+        return SnapshotIndex(path, check_interval=float(os.getenv("SNAPSHOT_CHECK_INTERVAL", "5")))
+    if backend == "chroma":
+        return ChromaIndex(path)
+    raise ValueError(f"Unknown retrieval backend: {backend}")
+
+
+def iter_collection(collection, include, page_rows=PAGE_ROWS):
+    """Yield `collection.get` results `page_rows` rows at a time, so a whole collection is never held at once."""
+    offset = 0
+    while True:
+        page = collection.get(include=include, limit=page_rows, offset=offset)
+        if not page["ids"]:
+            return
+        yield page
+        offset += len(page["ids"])
+
+
+def export_index(collection, out_dir, dtype="float32", page_rows=PAGE_ROWS):
+    """
+    Write `collection` out as a NumpyIndex snapshot with its LexicalIndex. The
+    directory is replaced atomically. Rows are read a page at a time and written
+    straight into the memory-mapped matrix and string columns; only the keyword
+    postings are held until the end.
+    """
+    if dtype not in DTYPES:
+        raise ValueError(f"Unsupported dtype {dtype}, expected one of {DTYPES}")
+
+    tmp_dir = f"{out_dir}.tmp"
+    shutil.rmtree(tmp_dir, ignore_errors=True)
+    os.makedirs(tmp_dir)
+
+    total = collection.count()
+    matrix = np.lib.format.open_memmap(
+        os.path.join(tmp_dir, "embeddings.npy"), mode="w+", dtype=np.dtype(dtype), shape=(total, EMBEDDING_DIM)
+    )
+    scales = np.ones(total, dtype=np.float32) if dtype == "int8" else None
+    columns = {name: StringColumnWriter(tmp_dir, name) for name in ("ids", "documents", "metadatas")}
+    lexical = LexicalWriter()
+
+    row = 0
+    for page in iter_collection(collection, ["embeddings", "documents", "metadatas"], page_rows):
+        block = np.asarray(page["embeddings"], dtype=np.float32).reshape(len(page["ids"]), EMBEDDING_DIM)
+        if row + len(block) > total:
+            raise RuntimeError("Collection grew during export")
+        norms = np.linalg.norm(block, axis=1, keepdims=True)
+        block /= np.where(norms == 0, 1.0, norms)
+        if dtype == "int8":
+            block_scales = np.abs(block).max(axis=1) / 127
+            block_scales[block_scales == 0] = 1.0
+            scales[row:row + len(block)] = block_scales
+            block = np.round(block / block_scales[:, None])
+        matrix[row:row + len(block)] = block.astype(dtype)
+
+        for cid, document, metadata in zip(page["ids"], page["documents"], page["metadatas"]):
+            columns["ids"].append(cid)
+            columns["documents"].append(document)
+            columns["metadatas"].append(json.dumps(metadata or {}))
+            lexical.append(cid, document, (metadata or {}).get("title"))
+        row += len(block)
+
+    if row != total:
+        raise RuntimeError(f"Collection changed during export ({row} rows read, {total} expected)")
+    matrix.flush()
+    del matrix
+    if scales is not None:
+        np.save(os.path.join(tmp_dir, "scales.npy"), scales)
+    for column in columns.values():
+        column.close()
+    lexical.write(tmp_dir)
+
+    old_dir = f"{out_dir}.old"
+    shutil.rmtree(old_dir, ignore_errors=True)
+    if os.path.exists(out_dir):
+        os.rename(out_dir, old_dir)
+    os.rename(tmp_dir, out_dir)
+    shutil.rmtree(old_dir, ignore_errors=True)
+    print(f"Exported {total} chunks ({dtype}) to {out_dir}")
+
+
+def publish_snapshot(collection, build_id, path="./msme_db", dtype="float32", keep=3):
+    """
+    Export `collection` as snapshot `build_id` and make it the live one.
+
+    The export is complete before CURRENT is swapped, so SnapshotIndex never
+    sees a partial build. Only the newest `keep` snapshots are kept; workers
+    still mapping a pruned one keep their open mappings until they move on.
+    """
+    snapshots = os.path.join(path, SNAPSHOTS)
+    os.makedirs(snapshots, exist_ok=True)
+    export_index(collection, os.path.join(snapshots, build_id), dtype=dtype)
+
+    tmp_path = os.path.join(snapshots, f"{CURRENT}.tmp")
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        f.write(build_id)
+    os.replace(tmp_path, os.path.join(snapshots, CURRENT))
+
+    builds = [
+        name for name in os.listdir(snapshots)
+        if os.path.isdir(os.path.join(snapshots, name)) and not name.endswith((".tmp", ".old"))
+    ]
+    builds.sort(key=lambda name: os.path.getmtime(os.path.join(snapshots, name)), reverse=True)
+    for name in builds[keep:]:
+        if name != build_id:
+            shutil.rmtree(os.path.join(snapshots, name), ignore_errors=True)
+
+
+def compare(path="./msme_db", dtype="float32", n_queries=200, n_results=3):
+    """
+    Recall and latency of the Chroma and NumPy backends on the same probes.
+
+    Probes are stored chunk embeddings with a little noise, so no API quota is
+    needed. Recall@k is measured against exact float32 search.
+    """
+    chroma = ChromaIndex(path)
+    out_dir = os.path.join(path, f"numpy_index_{dtype}")
+    export_index(chroma.db, out_dir, dtype=dtype)
+    numpy_index = NumpyIndex(out_dir)
+    if dtype == "float32":
+        exact = numpy_index
+    else:
+        exact_dir = os.path.join(path, "numpy_index_float32")
+        export_index(chroma.db, exact_dir)
+        exact = NumpyIndex(exact_dir)
+
+    rng = np.random.default_rng(0)
+    base = np.asarray(exact.matrix, dtype=np.float32)
+    picks = rng.integers(0, len(base), size=n_queries)
+    probes = base[picks] + rng.normal(0, 0.02, size=(n_queries, base.shape[1])).astype(np.float32)
+
+    report = {}
+    for name, index in (("chroma", chroma), ("numpy", numpy_index)):
+        latencies, hits = [], 0
+        for probe in probes:
+            truth = set(exact.search(probe, n_results)["ids"][0])
+            started = time.perf_counter()
+            found = index.search(probe.tolist(), n_results)["ids"][0]
+            latencies.append((time.perf_counter() - started) * 1000)
+            hits += len(truth.intersection(found))
+        latencies = np.array(latencies)
+        report[name] = {
+            "recall": hits / (n_queries * n_results),
+            "p50_ms": float(np.percentile(latencies, 50)),
+            "p95_ms": float(np.percentile(latencies, 95)),
+        }
+
+    for name, row in report.items():
+        print(f"{name:>6}: recall@{n_results}={row['recall']:.3f}  p50={row['p50_ms']:.2f}ms  p95={row['p95_ms']:.2f}ms")
+    return report
+
+
+if __name__ == "__main__":
+    # python -m core.index export [dtype] | python -m core.index compare [dtype]
+    command = sys.argv[1] if len(sys.argv) > 1 else "compare"
+    dtype = sys.argv[2] if len(sys.argv) > 2 else "float32"
+    if command == "export":
+        export_index(ChromaIndex().db, os.path.join("./msme_db", "numpy_index"), dtype=dtype)
+    else:
+        compare(dtype=dtype)
@@ -0,0 +1,218 @@
+import bisect
+import math
+import os
+import re
+from collections import Counter
+
+import numpy as np
+
+from .columns import StringColumn
+
+# Words that appear in almost every scheme title and say nothing about which one it is
+TITLE_STOPWORDS = {
+    "scheme", "schemes", "yojana", "yojna", "programme", "program", "mission", "fund", "the", "for",
+    "and", "of", "in", "to", "a", "an", "on", "under", "with", "by", "tell", "me", "about", "what",
+    "is", "details", "detail", "information", "info",
+    # section headings produced by "##" splits
+    "eligibility", "criteria", "how", "apply", "application", "benefits", "benefit", "features",
+    "documents", "required", "overview", "objective", "objectives", "introduction", "contact",
+    "assistance", "procedure", "process", "guidelines", "note",
+}
+
+
+def keyword_counts(text: str) -> Counter:
+    """Term counts over words of 4+ characters, the same keywords the ingestion step used to compute."""
+    return Counter(re.findall(r'\b\w{4,}\b', text.lower()))
+
+
+def title_tokens(text: str) -> frozenset:
+    return frozenset(t for t in re.findall(r'\w+', text.lower()) if t not in TITLE_STOPWORDS)
+
+
+def title_aliases(title: str) -> set:
+    """Token sets a user might name a scheme by: the full title, its leading name and any acronym in brackets."""
+    aliases = {title_tokens(title)}
+    aliases.add(title_tokens(re.split(r'\s+(?:for|under|of)\s+|\s*[(\-–:]', title, maxsplit=1, flags=re.I)[0]))
+    for acronym in re.findall(r'\(([^)]+)\)', title):
+        aliases.add(title_tokens(acronym))
+    aliases.discard(frozenset())
+    return aliases
+
+
+def chunk_title(content: str) -> str:
+    """Chunks are split on "Scheme:" / "##", so their first line is the scheme name."""
+    for line in content.splitlines():
+        if line.strip():
+            return line.strip()[:120]
+    return ""
+
+
+class LexicalIndex():
+    """
+    BM25 inverted index over chunk keywords, plus a scheme-title lookup.
+
+    Postings are flat arrays: the rows and term frequencies of `terms[i]` are
+    `rows[offsets[i]:offsets[i + 1]]` and `tfs[...]`, with `terms` sorted.
+    LexicalWriter stores them in each published snapshot, where `load`
+    memory-maps them, so worker processes share one copy like the vectors.
+    """
+    def __init__(self, ids, titles, doc_lens, terms, offsets, rows, tfs, k1=1.2, b=0.75):
+        self.ids = ids
+        self.doc_lens = doc_lens
+        self.terms = terms
+        self.offsets = offsets
+        self.rows = rows
+        self.tfs = tfs
+        self.k1 = k1
+        self.b = b
+        self.avgdl = float(np.mean(doc_lens)) if len(doc_lens) else 0.0
+        # Passages of a scheme share its title, so aliases are worked out once per title
+        self.aliases = {}
+        by_title = {}
+        for row, title in enumerate(titles):
+            if title not in by_title:
+                by_title[title] = title_aliases(title)
+            for tokens in by_title[title]:
+                self.aliases.setdefault(tokens, []).append(row)
+
+    @classmethod
+    def build(cls, ids, documents, titles=None):
+        """`titles` defaults to each document's first line; pass the parent scheme titles for passages."""
+        titles = titles if titles is not None else [None] * len(ids)
+        return cls.from_rows(zip(ids, documents, titles))
+
+    @classmethod
+    def from_rows(cls, rows):
+        """
+        Build in memory from an iterable of (id, document, title) rows, consumed
+        once, so documents can be streamed; a title of None means the document's first line.
+        """
+        writer = LexicalWriter()
+        for cid, content, title in rows:
+            writer.append(cid, content, title)
+        return writer.index()
+
+    @staticmethod
+    def exists(path):
+        return os.path.exists(os.path.join(path, "lexical_offsets.npy"))
+
+    @classmethod
+    def load(cls, path):
+        """Memory-map the index written into snapshot directory `path`, or None if it has none."""
+        if not cls.exists(path):
+            return None
+        return cls(
+            StringColumn(path, "ids"),
+            StringColumn(path, "lexical_titles"),
+            np.load(os.path.join(path, "lexical_doc_lens.npy"), mmap_mode="r"),
+            StringColumn(path, "lexical_terms"),
+            np.load(os.path.join(path, "lexical_offsets.npy"), mmap_mode="r"),
+            np.load(os.path.join(path, "lexical_rows.npy"), mmap_mode="r"),
+            np.load(os.path.join(path, "lexical_tfs.npy"), mmap_mode="r"),
+        )
+
+    def _postings(self, term):
+        """(rows, term frequencies) of `term`, empty when it is not indexed."""
+        i = bisect.bisect_left(self.terms, term)
+        if i == len(self.terms) or self.terms[i] != term:
+            return self.rows[:0], self.tfs[:0]
+        start, stop = self.offsets[i], self.offsets[i + 1]
+        return self.rows[start:stop], self.tfs[start:stop]
+
+    def search(self, query, n_results=10):
+        """Top chunk ids by BM25 score, best first."""
+        n = len(self.doc_lens)
+        scores = np.zeros(n)
+        for term in set(keyword_counts(query)):
+            rows, tfs = self._postings(term)
+            if not len(rows):
+                continue
+            idf = math.log(1 + (n - len(rows) + 0.5) / (len(rows) + 0.5))
+            norm = tfs + self.k1 * (1 - self.b + self.b * self.doc_lens[rows] / (self.avgdl or 1.0))
+            scores[rows] += idf * tfs * (self.k1 + 1) / norm
+
+        hits = np.flatnonzero(scores)
+        ranked = hits[np.argsort(-scores[hits], kind="stable")][:n_results]
+        return [self.ids[row] for row in ranked]
+
+    def match_name(self, query, max_chunks=3):
+        """
+        Chunk ids of the one scheme whose title is fully named in `query`, or None.
+
+        Titles are matched through `title_aliases`. A match needs at least two words (or one long word such as "PMEGP"),
+        one of them rare in the corpus, and must be unambiguous; otherwise
+        retrieval falls back to embeddings.
+        """
+        words = title_tokens(query)
+        rare = max(3, len(self.ids) // 50)
+        matches = {}
+        for tokens, rows in self.aliases.items():
+            if not tokens <= words:
+                continue
+            if len(tokens) < 2 and not any(len(t) >= 5 for t in tokens):
+                continue
+            # At least one title word has to be rare in the corpus to identify a scheme
+            if not any(len(t) >= 4 and len(self._postings(t)[0]) <= rare for t in tokens):
+                continue
+            matches[tokens] = set(rows)
+
+        if not matches:
+            return None
+
+        # Prefer the most specific name; bail out if two different schemes tie
+        best = max(matches, key=len)
+        if any(len(tokens) == len(best) and rows != matches[best] for tokens, rows in matches.items()):
+            return None
+        return [self.ids[row] for row in sorted(matches[best])[:max_chunks]]
+
+
+class LexicalWriter():
+    """
+    Collects postings row by row for a LexicalIndex. export_index feeds it the
+    snapshot's rows in order, so the index shares the snapshot's `ids` column.
+    """
+    def __init__(self):
+        self.ids = []
+        self.titles = []
+        self.doc_lens = []
+        self.postings = {}
+
+    def append(self, cid, content, title=None):
+        row = len(self.ids)
+        self.ids.append(cid)
+        self.titles.append(title or chunk_title(content))
+        counts = keyword_counts(content)
+        self.doc_lens.append(sum(counts.values()))
+        for term, tf in counts.items():
+            self.postings.setdefault(term, []).append((row, tf))
+
+    def _arrays(self):
+        terms = sorted(self.postings)
+        offsets = np.zeros(len(terms) + 1, dtype=np.int64)
+        offsets[1:] = np.cumsum([len(self.postings[term]) for term in terms])
+        rows = np.fromiter((row for term in terms for row, _ in self.postings[term]), dtype=np.int32, count=offsets[-1])
+        tfs = np.fromiter((tf for term in terms for _, tf in self.postings[term]), dtype=np.int32, count=offsets[-1])
+        return terms, offsets, rows, tfs
+
+    def index(self) -> LexicalIndex:
+        return LexicalIndex(self.ids, self.titles, np.array(self.doc_lens, dtype=np.int32), *self._arrays())
+
+    def write(self, path):
+        """Write into snapshot directory `path`, which must already hold the `ids` column for the same rows."""
+        terms, offsets, rows, tfs = self._arrays()
+        StringColumn.write(path, "lexical_terms", terms)
+        StringColumn.write(path, "lexical_titles", self.titles)
+        np.save(os.path.join(path, "lexical_doc_lens.npy"), np.array(self.doc_lens, dtype=np.int32))
+        np.save(os.path.join(path, "lexical_rows.npy"), rows)
+        np.save(os.path.join(path, "lexical_tfs.npy"), tfs)
+        # Written last: `exists` checks for it
+        np.save(os.path.join(path, "lexical_offsets.npy"), offsets)
+
+
+def reciprocal_rank_fusion(rankings, k=60, n_results=3):
+    """Fuse several best-first id lists into one."""
+    scores = {}
+    for ranking in rankings:
+        for rank, cid in enumerate(ranking):
+            scores[cid] = scores.get(cid, 0.0) + 1 / (k + rank + 1)
+    return sorted(scores, key=scores.get, reverse=True)[:n_results]
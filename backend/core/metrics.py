@@ -0,0 +1,126 @@
+import contextvars
+import threading
+import time
+from contextlib import contextmanager
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+SIZE_BUCKETS = (256, 1024, 4096, 8192, 16384, 32768, 65536, 131072)
+
+
+def _labels(label, value):
+    return f'{{{label}="{value}"}}' if label else ""
+
+
+class Histogram():
+    """Prometheus-style cumulative histogram with a single label."""
+    def __init__(self, name, help, buckets, label="stage"):
+        self.name = name
+        self.help = help
+        self.buckets = buckets
+        self.label = label
+        self.series = {}
+        self.lock = threading.Lock()
+
+    def observe(self, label_value, value):
+        with self.lock:
+            series = self.series.setdefault(label_value, {"counts": [0] * len(self.buckets), "sum": 0.0, "count": 0})
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    series["counts"][i] += 1
+            series["sum"] += value
+            series["count"] += 1
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} histogram"]
+        with self.lock:
+            for value, series in sorted(self.series.items()):
+                for bound, count in zip(self.buckets, series["counts"]):
+                    lines.append(f'{self.name}_bucket{{{self.label}="{value}",le="{bound}"}} {count}')
+                lines.append(f'{self.name}_bucket{{{self.label}="{value}",le="+Inf"}} {series["count"]}')
+                lines.append(f"{self.name}_sum{_labels(self.label, value)} {series['sum']}")
+                lines.append(f"{self.name}_count{_labels(self.label, value)} {series['count']}")
+        return lines
+
+
+class Counter():
+    def __init__(self, name, help, label="stage"):
+        self.name = name
+        self.help = help
+        self.label = label
+        self.values = {}
+        self.lock = threading.Lock()
+
+    def inc(self, label_value, amount=1):
+        with self.lock:
+            self.values[label_value] = self.values.get(label_value, 0) + amount
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} counter"]
+        with self.lock:
+            for value, total in sorted(self.values.items()):
+                lines.append(f"{self.name}{_labels(self.label, value)} {total}")
+        return lines
+
+
+STAGE_SECONDS = Histogram("msme_stage_seconds", "Latency of each request stage in seconds", LATENCY_BUCKETS)
+STAGE_ERRORS = Counter("msme_stage_errors_total", "Failed calls by request stage")
+REQUEST_SECONDS = Histogram("msme_request_seconds", "End-to-end latency by endpoint in seconds", LATENCY_BUCKETS, label="endpoint")
+PAYLOAD_CHARS = Histogram("msme_payload_chars", "Prompt and response sizes in characters", SIZE_BUCKETS, label="kind")
+
+METRICS = [STAGE_SECONDS, STAGE_ERRORS, REQUEST_SECONDS, PAYLOAD_CHARS]
+
+# Stage timings of the request being handled, for the Server-Timing header
+_request_timings = contextvars.ContextVar("request_timings", default=None)
+
+
+@contextmanager
+def stage(name):
+    """Time a block as stage `name`; exceptions are counted against the stage and re-raised."""
+    started = time.perf_counter()
+    try:
+        yield
+    except Exception:
+        STAGE_ERRORS.inc(name)
+        raise
+    finally:
+        elapsed = time.perf_counter() - started
+        STAGE_SECONDS.observe(name, elapsed)
+        timings = _request_timings.get()
+        if timings is not None:
+            timings[name] = timings.get(name, 0.0) + elapsed
+
+
+def observe_size(kind, text):
+    if text:
+        PAYLOAD_CHARS.observe(kind, len(text))
+
+
+def start_request():
+    """Begin collecting stage timings for the current request and return the dict they go into."""
+    timings = {}
+    _request_timings.set(timings)
+    return timings
+
+
+def server_timing(timings):
+    return ", ".join(f"{name};dur={seconds * 1000:.1f}" for name, seconds in timings.items())
+
+
+def gauge(name, help, values, label=None):
+    """Render a gauge from {label value: number} (or a bare number when `label` is None)."""
+    lines = [f"# HELP {name} {help}", f"# TYPE {name} gauge"]
+    if label is None:
+        lines.append(f"{name} {values}")
+    else:
+        for value, number in sorted(values.items()):
+            lines.append(f"{name}{_labels(label, value)} {number}")
+    return lines
+
+
+def render(extra=()):
+    lines = []
+    for metric in METRICS:
+        lines.extend(metric.render())
+    for extra_lines in extra:
+        lines.extend(extra_lines)
+    return "\n".join(lines) + "\n"
@@ -0,0 +1,98 @@
+import re
+import time
+import uuid
+from collections import OrderedDict
+
+from .attributes import query_filters
+from .metrics import gauge
+
+# Demonstratives that point back at schemes from the previous answer ("How to apply
+# for this?", "Are these free?"). Only "this"/"these" and their Hindi forms:
+# "that", "it" and "they" also start relative clauses and new questions ("schemes
+# that support exporters"). English, romanized Hindi and Devanagari Hindi; other
+# languages take the full path.
+FOLLOW_UP_MARKERS = {
+    "this", "these", "above", "mentioned",
+    "iske", "iska", "iski", "isme", "ismein", "isko", "inme", "inmein",
+    "इस", "इसके", "इसका", "इसकी", "इसमें", "इसे", "यह", "ये",
+}
+# "this year" and the like point at a time, not at the last answer
+TIME_WORDS = {"year", "month", "week", "quarter", "time", "season"}
+# Longer messages usually carry a new need rather than a question about the last answer
+FOLLOW_UP_MAX_WORDS = 12
+
+# \w stops at Devanagari vowel signs (it would split "इसके"), so the block is matched too, minus the dandas
+WORD_RE = re.compile(r"[\w\u0900-\u0963\u0966-\u097f]+")
+
+
+def _points_back(words) -> bool:
+    for i, word in enumerate(words):
+        if word in FOLLOW_UP_MARKERS and not (i + 1 < len(words) and words[i + 1] in TIME_WORDS):
+            return True
+    return False
+
+
+def is_follow_up(session, text: str) -> bool:
+    """
+    Whether `text` is a short question about the schemes already retrieved in
+    `session`: it points back at them and names no state, sector, target group
+    or size of its own (which would call for a new search).
+    """
+    if not session or not session.get("scheme_ids") or not session.get("language"):
+        return False
+    words = WORD_RE.findall(text.lower())
+    if not 0 < len(words) <= FOLLOW_UP_MAX_WORDS or not _points_back(words):
+        return False
+    return not query_filters(text)
+
+
+class SessionStore():
+    """
+    Conversation state by session id, as a size-bounded LRU with an idle TTL.
+
+    A session is a small dict: the detected `language`, the `scheme_ids` last
+    retrieved and the last `max_turns` (query, answer) pairs, with answers cut
+    to `max_answer_chars`, so follow-ups can be answered from the same schemes
+    with the previous answer in view.
+    """
+    def __init__(self, max_size=10000, ttl=1800, max_turns=2, max_answer_chars=1500):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.max_turns = max_turns
+        self.max_answer_chars = max_answer_chars
+        self.entries = OrderedDict()
+        self.follow_ups = 0
+        self.turns = 0
+
+    def open(self, session_id=None):
+        """
+        Return (session_id, session). Unknown or expired ids start a fresh
+        session under a new id, so callers cannot choose ids or share sessions.
+        """
+        now = time.monotonic()
+        entry = self.entries.get(session_id) if isinstance(session_id, str) else None
+        if entry is not None and entry["expires_at"] > now:
+            return session_id, entry["session"]
+
+        return uuid.uuid4().hex, {"language": None, "scheme_ids": [], "history": []}
+
+    def record(self, session_id, session, language, query, answer):
+        """Store a finished turn and refresh the session's TTL."""
+        self.turns += 1
+        session["language"] = language
+        session["history"] = (session["history"] + [(query, (answer or "")[:self.max_answer_chars])])[-self.max_turns:]
+
+        now = time.monotonic()
+        self.entries[session_id] = {"session": session, "expires_at": now + self.ttl}
+        self.entries.move_to_end(session_id)
+        # Oldest entries expire first, so expired ones sit at the front
+        while self.entries:
+            oldest = next(iter(self.entries.values()))
+            if len(self.entries) <= self.max_size and oldest["expires_at"] > now:
+                break
+            self.entries.popitem(last=False)
+
+    def metrics(self):
+        lines = gauge("msme_sessions", "Conversation sessions held in memory", len(self.entries))
+        lines += gauge("msme_session_turns", "Conversation turns answered, by path", {"follow_up": self.follow_ups, "all": self.turns}, label="kind")
+        return lines
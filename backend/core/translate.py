@@ -1,11 +1,42 @@
+import threading
+from collections import OrderedDict
+
 import requests
+from requests.adapters import HTTPAdapter
+
+
+class NMTError(Exception):
+    def __init__(self, status_code, text):
+        super().__init__(f"Error: {status_code} - {text}")
+        # Read by core/upstream.py to decide whether to retry
+        self.status_code = status_code
 
 
 class NMT():
-    def __init__(self,api_key:str, app_id:str):
+    """
+    Reverie NMT client.
+
+    Requests go over one pooled keep-alive session. `translate_many` packs many
+    strings into each request (the payload's `data` is a list), split so no
+    request exceeds `max_batch_chars` characters or `max_batch_items` strings,
+    and finished (text, src, tgt) translations are kept in a bounded LRU memo.
+    Safe to call from several threads.
+    """
+    def __init__(self,api_key:str, app_id:str, timeout=10, max_batch_chars=4000, max_batch_items=50, cache_size=4096, pool_size=8):
         self.api_key = api_key
         self.app_id = app_id
         self.url = "https://revapi.reverieinc.com/"
+        # (connect, read) seconds; requests waits forever without it
+        self.timeout = (3, timeout)
+        self.max_batch_chars = max_batch_chars
+        self.max_batch_items = max_batch_items
+        self.cache_size = cache_size
+        self.cache = OrderedDict()
+        self.lock = threading.Lock()
+        self.headers = {}
+
+        self.session = requests.Session()
+        self.session.mount("https://", HTTPAdapter(pool_connections=1, pool_maxsize=pool_size))
 
 
     def generate_headers(self, src_lang, tgt_lang, app_name="localization", app_version="3.0"):
@@ -21,17 +52,66 @@ class NMT():
         }
 
         return headers
-    
+
+    def _headers(self, src_lang, tgt_lang):
+        key = (src_lang, tgt_lang)
+        if key not in self.headers:
+            self.headers[key] = self.generate_headers(src_lang, tgt_lang)
+        return self.headers[key]
+
     def translate(self, text:str, src_lang:str, tgt_lang:str):
-        headers = self.generate_headers(src_lang, tgt_lang)
+        return self.translate_many([text], src_lang, tgt_lang)[0]
+
+    def translate_many(self, texts, src_lang:str, tgt_lang:str):
+        """Translate `texts` in order; blank strings are returned as they are."""
+        results = list(texts)
+        missing = {}
+        with self.lock:
+            for i, text in enumerate(texts):
+                if not text.strip():
+                    continue
+                key = (text, src_lang, tgt_lang)
+                if key in self.cache:
+                    self.cache.move_to_end(key)
+                    results[i] = self.cache[key]
+                else:
+                    missing.setdefault(text, []).append(i)
+
+        for batch in self._batches(list(missing)):
+            translated = self._post(batch, src_lang, tgt_lang)
+            with self.lock:
+                for text, out in zip(batch, translated):
+                    for i in missing[text]:
+                        results[i] = out
+                    self.cache[(text, src_lang, tgt_lang)] = out
+                    self.cache.move_to_end((text, src_lang, tgt_lang))
+                while len(self.cache) > self.cache_size:
+                    self.cache.popitem(last=False)
+        return results
+
+    def _batches(self, texts):
+        batch, size = [], 0
+        for text in texts:
+            if batch and (size + len(text) > self.max_batch_chars or len(batch) >= self.max_batch_items):
+                yield batch
+                batch, size = [], 0
+            # A string longer than the limit goes out on its own
+            batch.append(text)
+            size += len(text)
+        if batch:
+            yield batch
+
+    def _post(self, texts, src_lang, tgt_lang):
         payload = {
-            "data": [text],
+            "data": texts,
             "enableNmt": True,
             "enableLookup": True
         }
-        response = requests.post(self.url, headers=headers, json=payload)
-        if response.status_code == 200:
-            return response.json()['responseList'][0]["outString"]
-        else:
-            raise Exception(f"Error: {response.status_code} - {response.text}")
-        
\ No newline at end of file
+        response = self.session.post(self.url, headers=self._headers(src_lang, tgt_lang), json=payload, timeout=self.timeout)
+        if response.status_code != 200:
+            raise NMTError(response.status_code, response.text)
+
+        translated = [item["outString"] for item in response.json()["responseList"]]
+        if len(translated) != len(texts):
+            raise NMTError(502, f"expected {len(texts)} translations, got {len(translated)}")
+        return translated
@@ -0,0 +1,248 @@
+import asyncio
+import os
+import random
+import time
+
+from .metrics import Counter, gauge
+
+# HTTP statuses worth another attempt: rate limiting and server-side failures
+RETRY_STATUSES = {408, 429, 500, 502, 503, 504}
+
+UPSTREAM_RETRIES = Counter("msme_upstream_retries_total", "Upstream calls retried, by stage")
+UPSTREAM_HEDGES = Counter("msme_upstream_hedges_total", "Duplicate requests sent to cut tail latency, by stage")
+UPSTREAM_REJECTED = Counter("msme_upstream_rejected_total", "Calls failed fast by an open circuit, by stage")
+
+
+class UpstreamUnavailable(Exception):
+    """An upstream is failing or too slow; raised instead of waiting on it."""
+
+
+def is_retriable(error) -> bool:
+    """Timeouts, connection failures and 429/5xx responses; anything else is the caller's fault."""
+    if isinstance(error, (asyncio.TimeoutError, ConnectionError, OSError)):
+        return True
+    # google.genai.errors.APIError carries `code`, HTTP client responses `status_code`
+    status = getattr(error, "code", None) or getattr(error, "status_code", None)
+    if status in RETRY_STATUSES:
+        return True
+    return type(error).__module__.split(".")[0] in ("httpx", "httpcore", "aiohttp")
+
+
+class CircuitBreaker():
+    """
+    Fails fast after `failure_threshold` consecutive upstream failures.
+
+    Once open, calls are rejected for `reset_timeout` seconds; then a single
+    trial call is let through (half-open) and its outcome closes or re-opens
+    the circuit.
+    """
+    def __init__(self, name, failure_threshold=5, reset_timeout=30):
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.failures = 0
+        self.opened_at = None
+        self.trial = False
+
+    @property
+    def state(self):
+        if self.opened_at is None:
+            return "closed"
+        return "half_open" if self.trial or time.monotonic() - self.opened_at >= self.reset_timeout else "open"
+
+    def allow(self):
+        if self.opened_at is None:
+            return True
+        if not self.trial and time.monotonic() - self.opened_at >= self.reset_timeout:
+            self.trial = True
+            return True
+        return False
+
+    def success(self):
+        if self.opened_at is not None:
+            print(f"Circuit {self.name} closed")
+        self.failures = 0
+        self.opened_at = None
+        self.trial = False
+
+    def abandon(self):
+        """The trial call was cancelled before it had an outcome; let the next call try instead."""
+        self.trial = False
+
+    def failure(self):
+        self.failures += 1
+        if self.trial or (self.opened_at is None and self.failures >= self.failure_threshold):
+            if not self.trial:
+                print(f"Circuit {self.name} opened after {self.failures} failures")
+            self.opened_at = time.monotonic()
+            self.trial = False
+
+
+class Upstream():
+    """
+    Per-attempt timeout, overall deadline, jittered retries, optional hedging
+    and a shared circuit breaker around calls to one upstream stage.
+
+    `hedge_after` (seconds) sends a duplicate request when the first one has
+    not answered by then and keeps whichever finishes first; only use it for
+    idempotent calls.
+    """
+    def __init__(self, name, breaker, timeout=10.0, retries=2, backoff=0.2, hedge_after=None, deadline=None):
+        self.name = name
+        self.breaker = breaker
+        self.timeout = timeout
+        self.retries = retries
+        self.backoff = backoff
+        self.hedge_after = hedge_after
+        self.deadline = deadline or timeout * (retries + 1)
+
+    async def call(self, func, *args, **kwargs):
+        """Await `func(*args, **kwargs)` under this stage's policy."""
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + self.deadline
+        attempt = 0
+        while True:
+            if not self.breaker.allow():
+                UPSTREAM_REJECTED.inc(self.name)
+                raise UpstreamUnavailable(f"{self.breaker.name} is unavailable ({self.name})")
+            # Let through while the circuit is open: this call is the half-open trial
+            trial = self.breaker.opened_at is not None
+
+            remaining = deadline - loop.time()
+            try:
+                result = await self._attempt(lambda: func(*args, **kwargs), min(self.timeout, remaining))
+            except asyncio.CancelledError:
+                # A client disconnect says nothing about the upstream, but the
+                # trial slot must not stay taken or the circuit never closes
+                if trial:
+                    self.breaker.abandon()
+                raise
+            except Exception as e:
+                if not is_retriable(e):
+                    # The upstream answered, the request itself was bad
+                    self.breaker.success()
+                    raise
+                self.breaker.failure()
+                print(f"{self.name} attempt {attempt + 1} failed: {type(e).__name__} {e}")
+
+                attempt += 1
+                delay = random.uniform(0, self.backoff * 2 ** attempt)
+                if attempt > self.retries or loop.time() + delay >= deadline:
+                    raise UpstreamUnavailable(f"{self.name} failed after {attempt} attempts: {e}") from e
+                UPSTREAM_RETRIES.inc(self.name)
+                await asyncio.sleep(delay)
+                continue
+
+            self.breaker.success()
+            return result
+
+    async def _attempt(self, start, timeout):
+        if not self.hedge_after or self.hedge_after >= timeout:
+            return await asyncio.wait_for(start(), timeout)
+
+        loop = asyncio.get_running_loop()
+        give_up = loop.time() + timeout
+        pending = {asyncio.ensure_future(start())}
+        hedged = False
+        error = None
+        try:
+            while True:
+                left = give_up - loop.time()
+                wait = left if hedged else min(self.hedge_after, left)
+                done, pending = await asyncio.wait(pending, timeout=max(wait, 0), return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    if task.exception() is None:
+                        return task.result()
+                    error = task.exception()
+                if not pending:
+                    raise error
+                if loop.time() >= give_up:
+                    raise asyncio.TimeoutError()
+                if not hedged and not done:
+                    # No answer yet: race a duplicate against the first try
+                    hedged = True
+                    UPSTREAM_HEDGES.inc(self.name)
+                    pending.add(asyncio.ensure_future(start()))
+        finally:
+            for task in pending:
+                task.cancel()
+
+    async def stream(self, open_stream):
+        """
+        Yield the chunks of the async iterator returned by `await open_stream()`.
+
+        Opening the stream and receiving the first chunk are retried like `call`;
+        after that nothing is retried (text has been sent on), but every chunk
+        must arrive within the per-attempt timeout.
+        """
+        async def first_chunk():
+            iterator = (await open_stream()).__aiter__()
+            try:
+                return await iterator.__anext__(), iterator
+            except StopAsyncIteration:
+                return None, None
+
+        chunk, iterator = await self.call(first_chunk)
+        if iterator is None:
+            return
+        yield chunk
+        while True:
+            try:
+                chunk = await asyncio.wait_for(iterator.__anext__(), self.timeout)
+            except StopAsyncIteration:
+                return
+            except asyncio.TimeoutError as e:
+                raise UpstreamUnavailable(f"{self.name} stalled mid-stream") from e
+            yield chunk
+
+
+BREAKERS = {
+    provider: CircuitBreaker(
+        provider,
+        failure_threshold=int(os.getenv("BREAKER_FAILURES", "5")),
+        reset_timeout=float(os.getenv("BREAKER_RESET_SECONDS", "30")),
+    )
+    for provider in ("gemini", "reverie")
+}
+
+# stage: (provider, timeout s, retries, hedge after s). Override with
+# UPSTREAM_<STAGE>_TIMEOUT, UPSTREAM_<STAGE>_RETRIES and UPSTREAM_<STAGE>_HEDGE (0 disables).
+DEFAULTS = {
+    "translate": ("gemini", 8.0, 2, 2.0),
+    "translate_audio": ("gemini", 30.0, 1, None),
+    "audio_upload": ("gemini", 30.0, 1, None),
+    "embed": ("gemini", 5.0, 2, 1.0),
+    # For streams the timeout applies to the first and every following chunk
+    "generate": ("gemini", 30.0, 1, None),
+    "nmt": ("reverie", 5.0, 1, None),
+}
+
+_upstreams = {}
+
+
+def upstream(stage) -> Upstream:
+    """The shared policy for calls made in `stage`."""
+    if stage not in _upstreams:
+        provider, timeout, retries, hedge_after = DEFAULTS[stage]
+        prefix = f"UPSTREAM_{stage.upper()}_"
+        hedge_after = float(os.getenv(prefix + "HEDGE", str(hedge_after or 0))) or None
+        _upstreams[stage] = Upstream(
+            stage,
+            BREAKERS[provider],
+            timeout=float(os.getenv(prefix + "TIMEOUT", str(timeout))),
+            retries=int(os.getenv(prefix + "RETRIES", str(retries))),
+            hedge_after=hedge_after,
+        )
+    return _upstreams[stage]
+
+
+def metrics():
+    states = {"closed": 0, "half_open": 1, "open": 2}
+    lines = []
+    for counter in (UPSTREAM_RETRIES, UPSTREAM_HEDGES, UPSTREAM_REJECTED):
+        lines += counter.render()
+    lines += gauge(
+        "msme_circuit_state", "Circuit breaker state per provider (0 closed, 1 half-open, 2 open)",
+        {name: states[breaker.state] for name, breaker in BREAKERS.items()}, label="provider",
+    )
+    return lines
@@ -1,68 +1,282 @@
-import chromadb
-from google.genai import types
+import asyncio
+import json
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+
+from pydantic import BaseModel
+
+from .attributes import matches, to_where
+from .batcher import EmbeddingBatcher
+from .cache import EmbeddingCache, SemanticCache
+from .context import ContextBuilder
+from .index import SnapshotIndex, make_index
+from .lexical import reciprocal_rank_fusion
+from .metrics import STAGE_SECONDS, gauge, observe_size, stage
+from .upstream import UpstreamUnavailable, upstream
+
+
+BUILD_STAMP = "build_id"
+# Candidates taken from each retriever before reciprocal-rank fusion
+HYBRID_CANDIDATES = 20
+# Passages handed to the context builder, which trims them to the token budget
+PASSAGE_CANDIDATES = 12
+# Returned when the model produces no text (e.g. a blocked response)
+NO_ANSWER = "Sorry, I could not generate an answer. Please rephrase your question or try again."
+NO_SCHEMES = "No relevant schemes found. Please try different keywords or check database content."
+# embed_content accepts at most this many texts per call
+EMBED_CALL_MAX = 100
+
+
+class ProfileAnswer(BaseModel):
+    profile: int
+    answer: str
+
+
+def cache_scope(additional_info, where):
+    """Answers are only shared between queries with the same language instruction and filters."""
+    return f"{additional_info}|{json.dumps(where, sort_keys=True)}" if where else additional_info
 
 
 class Vector:
     """
     A class to handle vector database operations for MSME schemes using ChromaDB and Google Gemini API.
     """
-    def __init__(self, genai_client, path="./msme_db"):
-        self.client = chromadb.PersistentClient(path=path)
+    def __init__(self, genai_client, path="./msme_db", max_workers=None, backend=None, index=None):
+        self.path = path
         self.genai = genai_client
-        self.db = self.client.get_collection("msme_schemes")
+        # "chroma" (default) or "numpy" for the shared read-only snapshots, see
+        # core/index.py, unless an index is passed in
+        self.index = index if index is not None else make_index(backend, path)
+        # BM25 over chunk keywords, published with each snapshot by msme-rag.py;
+        # retrieval is vector-only without it. The numpy backend's SnapshotIndex
+        # already follows the snapshots, otherwise one follows just the postings.
+        if isinstance(self.index, SnapshotIndex):
+            self.snapshots = self.index
+        else:
+            self.snapshots = SnapshotIndex(path, check_interval=float(os.getenv("SNAPSHOT_CHECK_INTERVAL", "5")), vectors=False)
+        # Index searches are synchronous, so they run on a small dedicated pool
+        # instead of blocking the event loop.
+        max_workers = max_workers or int(os.getenv("CHROMA_WORKERS", "4"))
+        self.executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="chroma")
+        self.embeddings = EmbeddingCache(
+            max_size=int(os.getenv("EMBED_CACHE_SIZE", "1024")),
+            path=os.getenv("EMBED_CACHE_PATH"),
+        )
+        # Concurrent cache misses share batched embed_content calls
+        self.batcher = EmbeddingBatcher(
+            self._embed_many,
+            window_ms=float(os.getenv("EMBED_BATCH_WINDOW_MS", "5")),
+            max_batch=int(os.getenv("EMBED_BATCH_MAX", "32")),
+        )
+        self.context = ContextBuilder(
+            token_budget=int(os.getenv("CONTEXT_TOKEN_BUDGET", "2000")),
+            max_schemes=int(os.getenv("CONTEXT_MAX_SCHEMES", "3")),
+        )
+        self.answers = SemanticCache(
+            max_size=int(os.getenv("ANSWER_CACHE_SIZE", "512")),
+            threshold=float(os.getenv("ANSWER_CACHE_THRESHOLD", "0.95")),
+            ttl=float(os.getenv("ANSWER_CACHE_TTL", "3600")),
+            version_fn=self.build_id,
+        )
 
-    def query(self, query, additional_info=None):
-        """Query the vector database for relevant MSME schemes based on user input.
+    def metrics(self):
+        """Cache, batching and context statistics in Prometheus text lines."""
+        lines = []
+        for name, cache in (("embedding", self.embeddings), ("answer", self.answers)):
+            stats = cache.stats()
+            lines += gauge(f"msme_{name}_cache_hit_rate", f"Hit rate of the {name} cache", stats["hit_rate"])
+            lines += gauge(f"msme_{name}_cache_requests", f"Lookups in the {name} cache", {"hit": stats["hits"], "miss": stats["misses"]}, label="result")
+            lines += gauge(f"msme_{name}_cache_size", f"Entries in the {name} cache", stats["size"])
+        lines += gauge("msme_embed_batch_size", "Average coalesced embedding batch size", self.batcher.stats()["avg_batch_size"])
+        context = self.context.stats()
+        lines += gauge("msme_context_tokens", "Estimated tokens retrieved vs. placed in prompts", {"retrieved": context["retrieved_tokens"], "prompt": context["context_tokens"]}, label="kind")
+        return lines
 
-        Args:
-            query (str): User input query (MUST BE IN ENGLISH).
-        Returns:
-            str: Recommended schemes and follow-up questions.    
-        """
+    def warm(self):
+        """Pull the index segment and metadata into memory with a throwaway search."""
+        self.index.warm()
 
+    def build_id(self):
+        """Identifier of the current index build, written by msme-rag.py after every rebuild."""
         try:
-            query_embedding = self.genai.models.embed_content(
-                model="models/embedding-001",
-                contents=query,
-                config=types.EmbedContentConfig(task_type="RETRIEVAL_QUERY")
-            )    
-
-        except Exception as e:
-            print(f"Embedding failed: {e}")
+            with open(os.path.join(self.path, BUILD_STAMP), "r", encoding="utf-8") as f:
+                return f.read().strip()
+        except OSError:
             return None
-        
+
+    def _lexical(self):
+        """
+        The keyword index for use on the event loop: whichever build is open.
+        New builds are only opened by index searches, which run on the executor.
+        """
+        return self.snapshots.lexical
+
+    async def _run(self, func, *args, **kwargs):
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self.executor, partial(func, *args, **kwargs))
+
+    async def embed(self, query):
+        """Return the RETRIEVAL_QUERY embedding for `query`, served from the cache when possible."""
+        embedding = self.embeddings.get(query)
+        if embedding is not None:
+            return embedding
+
+        with stage("embed"):
+            embedding = await self.batcher.embed(query)
+        self.embeddings.put(query, embedding)
+        return embedding
+
+    async def _embed_many(self, queries):
+        from google.genai import types
+
+        response = await upstream("embed").call(
+            self.genai.aio.models.embed_content,
+            model="models/embedding-001",
+            contents=queries,
+            config=types.EmbedContentConfig(task_type="RETRIEVAL_QUERY")
+        )
+        return [e.values for e in response.embeddings]
+
+    def _search(self, query, query_embedding, n_results=3, where=None):
+        """Vector search, fused with BM25 results when the lexical index is available; `where` filters both."""
+        return self._search_many([query], [query_embedding], n_results, where)[0]
+
+    def _search_many(self, queries, query_embeddings, n_results=3, where=None):
+        """`_search` for several queries with a single index call; returns one result dict per query."""
+        lexical = self.snapshots.current_lexical()
+        candidates = n_results if lexical is None else HYBRID_CANDIDATES
+        results = self.index.search_many(query_embeddings, n_results=candidates, where=where)
+
+        searches = []
+        for i, query in enumerate(queries):
+            hits = {key: [results[key][i]] for key in ("ids", "documents", "metadatas")}
+            searches.append(hits if lexical is None else self._fuse(lexical, query, hits, n_results, where))
+        return searches
+
+    def _fuse(self, lexical, query, results, n_results, where=None):
+        found = {
+            cid: (doc, meta)
+            for cid, doc, meta in zip(results["ids"][0], results["documents"][0], results["metadatas"][0])
+        }
+
+        keyword_ids = lexical.search(query, n_results=HYBRID_CANDIDATES)
+        if where is not None:
+            # BM25 knows nothing about metadata, so its hits are checked here
+            unseen = [cid for cid in keyword_ids if cid not in found]
+            if unseen:
+                extra = self.index.get(unseen)
+                for cid, doc, meta in zip(extra["ids"][0], extra["documents"][0], extra["metadatas"][0]):
+                    found[cid] = (doc, meta)
+            keyword_ids = [cid for cid in keyword_ids if cid in found and matches(where, found[cid][1])]
+
+        fused = reciprocal_rank_fusion([results["ids"][0], keyword_ids], n_results=n_results)
+        missing = [cid for cid in fused if cid not in found]
+        if missing:
+            extra = self.index.get(missing)
+            for cid, doc, meta in zip(extra["ids"][0], extra["documents"][0], extra["metadatas"][0]):
+                found[cid] = (doc, meta)
+
+        fused = [cid for cid in fused if cid in found]
+        return {
+            "ids": [fused],
+            "documents": [[found[cid][0] for cid in fused]],
+            "metadatas": [[found[cid][1] for cid in fused]],
+        }
+
+    async def _prepare(self, query, additional_info=None, session=None, follow_up=False, where=None):
+        """Embed, check the answer cache and retrieve.
+
+        Returns (embedding, answer, prompt): `answer` is set when no generation is
+        needed (cache hit or nothing retrieved), otherwise `prompt` holds the
+        generation prompt. If embedding fails retrieval falls back to BM25, and
+        UpstreamUnavailable is raised when that is not possible. Queries naming a scheme
+        are answered from the lexical index without an embedding (embedding None),
+        as are follow-ups, which reuse the chunks in `session["scheme_ids"]`.
+        The chunk ids retrieved are written back to `session`. `where` restricts
+        the search to matching metadata and is dropped when nothing matches.
+        """
+        lexical = self._lexical()
+        if lexical is not None:
+            ids = lexical.match_name(query, max_chunks=PASSAGE_CANDIDATES)
+            if ids:
+                try:
+                    with stage("retrieve"):
+                        results = await self._run(self.index.get, ids)
+                    if results["documents"][0]:
+                        self._remember(session, results)
+                        return None, None, self.build_prompt(query, results, additional_info)
+                except Exception as e:
+                    print(f"Name lookup failed: {e}")
+
+        if follow_up:
+            try:
+                with stage("retrieve"):
+                    results = await self._run(self.index.get, session["scheme_ids"])
+                # Empty when the chunks were dropped by a rebuild
+                if results["documents"][0]:
+                    return None, None, self.build_prompt(query, results, additional_info, history=session["history"])
+            except Exception as e:
+                print(f"Follow-up lookup failed: {e}")
+
         try:
-            results = self.db.query(
-                query_embeddings=query_embedding.embeddings[0].values,
-                n_results=3,
-                include=["documents", "metadatas"]
-            )
+            query_embedding = await self.embed(query)
         except Exception as e:
-            print(f"Query failed: {e}")
-            return None
-        
-        if not results["documents"]:
-            return "No relevant schemes found. Please try different keywords or check database content."
-        
-        # Prepare scheme info
-        scheme_info = []
-        for doc, meta in zip(results["documents"][0], results["metadatas"][0]):
-            scheme_info.append({
-                "content": doc,
-                "eligibility": meta.get("eligibility", "Please refer to official sites for eligibility details."),
-                "description": meta.get("description", "Description not available. Please refer to official sites."),
-                "application": "Includes application details" if meta.get("has_application") else "Please refer to official sites for application instructions."
-            })
-
-        scheme_details = "\n".join([
-            f"• {s['content']}\n  - Eligibility: {s['eligibility']}\n  - Description: {s['description']}\n  - Application Info: {s['application']}"
-            for s in scheme_info
-        ])
+            print(f"Embedding failed: {e}")
+            return None, None, await self._lexical_prompt(query, additional_info, session, e)
+
+        cached = self.answers.get(query_embedding, scope=cache_scope(additional_info, where))
+        if cached is not None:
+            # The chunks behind a cached answer are not known
+            if session is not None:
+                session["scheme_ids"] = []
+            return query_embedding, cached, None
+
+        with stage("retrieve"):
+            results = await self._run(self._search, query, query_embedding, n_results=PASSAGE_CANDIDATES, where=where)
+            if where is not None and not results["documents"][0]:
+                print(f"No chunks match {where}, searching without filters")
+                results = await self._run(self._search, query, query_embedding, n_results=PASSAGE_CANDIDATES)
+
+        if not results["documents"] or not results["documents"][0]:
+            return query_embedding, NO_SCHEMES, None
+
+        self._remember(session, results)
+        return query_embedding, None, self.build_prompt(query, results, additional_info)
+
+    async def _lexical_prompt(self, query, additional_info, session, error):
+        """Keyword-only retrieval for when the embedding upstream is down; re-raises `error` without a lexical index."""
+        lexical = self._lexical()
+        ids = lexical.search(query, n_results=PASSAGE_CANDIDATES) if lexical is not None else []
+        if not ids:
+            raise UpstreamUnavailable(f"Embedding failed: {error}") from error
 
+        print(f"Falling back to keyword retrieval for {query!r}")
+        with stage("retrieve"):
+            results = await self._run(self.index.get, ids)
+        if not results["documents"][0]:
+            raise UpstreamUnavailable(f"Embedding failed: {error}") from error
+        self._remember(session, results)
+        return self.build_prompt(query, results, additional_info)
+
+    def _remember(self, session, results):
+        if session is not None:
+            session["scheme_ids"] = list(results["ids"][0])
+
+    def build_prompt(self, query, results, additional_info=None, history=None):
+        with stage("context"):
+            scheme_details = self.context.build(results)
+
+        conversation = ""
+        if history:
+            turns = "\n".join(f"User: {q}\nAssistant: {a}" for q, a in history)
+            conversation = f"This is a follow-up. Earlier in this conversation:\n{turns}\n"
 
         prompt = f"""
         You are an expert MSME scheme advisor.
 
+        {conversation}
         User Query: "{query}"
 
         You have access to relevant MSME scheme documents retrieved based on the query.
@@ -93,11 +307,230 @@ class Vector:
 
         Only show schemes that are a good match. If no scheme matches, suggest visiting the official MSME portal.
         """
-        response = self.genai.models.generate_content(
-            model="gemini-2.0-flash",
-            contents=[prompt]
-        )
+        return prompt
+
+    async def query(self, query, additional_info=None, session=None, follow_up=False, filters=None):
+        """Query the vector database for relevant MSME schemes based on user input.
+
+        Args:
+            query (str): User input query (MUST BE IN ENGLISH, except for follow-ups).
+            session (dict): Conversation state from core/session.py, updated with the retrieved chunk ids.
+            follow_up (bool): Answer from the schemes already in `session` instead of retrieving.
+            filters (dict): Scheme attributes to restrict the search to, see core/attributes.py.
+        Returns:
+            str: Recommended schemes and follow-up questions.    
+        """
+        where = to_where(filters or {})
+        query_embedding, answer, prompt = await self._prepare(query, additional_info, session, follow_up, where)
+        if prompt is None:
+            return answer
+
+        answer = await self._generate(prompt)
+        if answer is not NO_ANSWER and query_embedding is not None:
+            self.answers.put(query_embedding, answer, scope=cache_scope(additional_info, where))
+        return answer
+
+    async def _generate(self, prompt):
+        observe_size("prompt", prompt)
+        with stage("generate"):
+            response = await upstream("generate").call(
+                self.genai.aio.models.generate_content,
+                model="gemini-2.0-flash",
+                contents=[prompt]
+            )
+        if not response.text:
+            return NO_ANSWER
+        observe_size("response", response.text)
         return response.text
+
+    async def query_stream(self, query, additional_info=None, session=None, follow_up=False, filters=None):
+        """Same as `query`, but yields the answer text chunk by chunk as the model generates it."""
+        where = to_where(filters or {})
+        query_embedding, answer, prompt = await self._prepare(query, additional_info, session, follow_up, where)
+        if prompt is None:
+            if answer is not None:
+                yield answer
+            return
+
+        observe_size("prompt", prompt)
+        parts = []
+        started = time.perf_counter()
+        with stage("generate"):
+            stream = upstream("generate").stream(lambda: self.genai.aio.models.generate_content_stream(
+                model="gemini-2.0-flash",
+                contents=[prompt]
+            ))
+            async for chunk in stream:
+                if chunk.text:
+                    if not parts:
+                        STAGE_SECONDS.observe("first_token", time.perf_counter() - started)
+                    parts.append(chunk.text)
+                    yield chunk.text
+        observe_size("response", "".join(parts))
+
+        if parts and query_embedding is not None:
+            self.answers.put(query_embedding, "".join(parts), scope=cache_scope(additional_info, where))
+
+    async def embed_many(self, queries):
+        """Embeddings for `queries` (None where embedding failed), from the cache or in calls of up to EMBED_CALL_MAX texts."""
+        embeddings = [self.embeddings.get(query) for query in queries]
+        missing = list(dict.fromkeys(q for q, e in zip(queries, embeddings) if e is None))
+        computed = {}
+        for i in range(0, len(missing), EMBED_CALL_MAX):
+            batch = missing[i:i + EMBED_CALL_MAX]
+            try:
+                with stage("embed"):
+                    vectors = await self._embed_many(batch)
+            except Exception as e:
+                print(f"Embedding failed for {len(batch)} queries: {e}")
+                continue
+            for query, vector in zip(batch, vectors):
+                self.embeddings.put(query, vector)
+                computed[query] = vector
+        return [e if e is not None else computed.get(q) for q, e in zip(queries, embeddings)]
+
+    async def screen(self, queries, additional_infos, filters, concurrency=4, group_max=8):
+        """
+        Answer a batch of queries, yielding {"index", "response" | "error", "group_size"} as answers complete.
+
+        Queries are embedded in bulk and searched with one index call per
+        distinct filter. Queries with the same language instruction whose top
+        schemes are the same set share one generation of up to `group_max`
+        profiles, which answers each of them; at most `concurrency`
+        generations run at once.
+        """
+        embeddings = await self.embed_many(queries)
+        wheres = [to_where(f or {}) for f in filters]
+        retrieved = {}
+        pending = []
+        for i, embedding in enumerate(embeddings):
+            if embedding is None:
+                yield {"index": i, "error": "Embedding failed", "group_size": 1}
+                continue
+            cached = self.answers.get(embedding, scope=cache_scope(additional_infos[i], wheres[i]))
+            if cached is not None:
+                yield {"index": i, "response": cached, "group_size": 1}
+                continue
+            pending.append(i)
+
+        by_where = {}
+        for i in pending:
+            by_where.setdefault(json.dumps(wheres[i], sort_keys=True), []).append(i)
+        for indices in by_where.values():
+            where = wheres[indices[0]]
+            with stage("retrieve"):
+                results = await self._run(
+                    self._search_many, [queries[i] for i in indices], [embeddings[i] for i in indices],
+                    n_results=PASSAGE_CANDIDATES, where=where,
+                )
+            for i, result in zip(indices, results):
+                if where is not None and not result["documents"][0]:
+                    result = await self._run(self._search, queries[i], embeddings[i], n_results=PASSAGE_CANDIDATES)
+                retrieved[i] = result
+
+        groups = {}
+        for i in pending:
+            result = retrieved[i]
+            if not result["documents"][0]:
+                yield {"index": i, "response": NO_SCHEMES, "group_size": 1}
+                continue
+            parents = []
+            for cid, meta in zip(result["ids"][0], result["metadatas"][0]):
+                parent = (meta or {}).get("parent", cid)
+                if parent not in parents:
+                    parents.append(parent)
+            key = (additional_infos[i], frozenset(parents[:self.context.max_schemes]))
+            groups.setdefault(key, []).append(i)
+
+        limit = asyncio.Semaphore(concurrency)
+
+        async def answer(indices):
+            async with limit:
+                try:
+                    if len(indices) == 1:
+                        return {indices[0]: await self._generate(
+                            self.build_prompt(queries[indices[0]], retrieved[indices[0]], additional_infos[indices[0]])
+                        )}
+                    return await self._generate_group(indices, queries, retrieved, additional_infos)
+                except Exception as e:
+                    return {i: e for i in indices}
+
+        tasks = [
+            asyncio.ensure_future(answer(members[j:j + group_max]))
+            for members in groups.values()
+            for j in range(0, len(members), group_max)
+        ]
+        try:
+            for next_done in asyncio.as_completed(tasks):
+                answers = await next_done
+                for i, text in answers.items():
+                    if isinstance(text, Exception):
+                        yield {"index": i, "error": str(text), "group_size": len(answers)}
+                        continue
+                    if text is not NO_ANSWER:
+                        self.answers.put(embeddings[i], text, scope=cache_scope(additional_infos[i], wheres[i]))
+                    yield {"index": i, "response": text, "group_size": len(answers)}
+        finally:
+            for task in tasks:
+                task.cancel()
+
+    async def _generate_group(self, indices, queries, retrieved, additional_infos):
+        """One structured generation answering every profile in `indices`; falls back to one call per profile."""
+        prompt = self.build_group_prompt([queries[i] for i in indices], retrieved[indices[0]], additional_infos[indices[0]])
+        observe_size("prompt", prompt)
+        try:
+            with stage("generate"):
+                response = await upstream("generate").call(
+                    self.genai.aio.models.generate_content,
+                    model="gemini-2.0-flash",
+                    contents=[prompt],
+                    config={
+                        'response_mime_type': 'application/json',
+                        'response_schema': list[ProfileAnswer],
+                    },
+                )
+            answers = {item.profile: item.answer for item in response.parsed or []}
+            if sorted(answers) == list(range(1, len(indices) + 1)):
+                observe_size("response", response.text)
+                return {i: answers[n] or NO_ANSWER for n, i in enumerate(indices, 1)}
+            print(f"Group answer covered profiles {sorted(answers)} of {len(indices)}, answering one by one")
+        except Exception as e:
+            print(f"Group generation failed ({e}), answering one by one")
+
+        texts = await asyncio.gather(*(
+            self._generate(self.build_prompt(queries[i], retrieved[i], additional_infos[i])) for i in indices
+        ), return_exceptions=True)
+        return dict(zip(indices, texts))
+
+    def build_group_prompt(self, queries, results, additional_info=None):
+        with stage("context"):
+            scheme_details = self.context.build(results)
+        profiles = "\n".join(f'Profile {n}: "{query}"' for n, query in enumerate(queries, 1))
+
+        prompt = f"""
+        You are an expert MSME scheme advisor screening several enterprise profiles against the same schemes.
+
+        {profiles}
+
+        {additional_info}
+
+        ------------------------
+        RETRIEVED SCHEME DETAILS:
+        {scheme_details}
+        ------------------------
+
+        TASK:
+        For EACH profile, recommend only the schemes above that suit that profile, formatted as:
+
+        **Recommended Schemes**
+        - **[Scheme Name]**: [Brief description or benefit]
+        - **Eligibility**: [...]
+        - **Application**: [...]
+
+        If no scheme suits a profile, say so and suggest visiting the official MSME portal.
+        Return one entry per profile, with `profile` set to its number.
+        """
+        return prompt
         
 
 # from dotenv import load_dotenv;load_dotenv()
@@ -106,4 +539,5 @@ class Vector:
 # client = genai.Client(api_key=os.getenv("GOOGLE_API_KEY"))
 
 # base = Vector(client)
-# print(base.query("What are the schemes for women entreprenuers in India?"))
\ No newline at end of file
+# import asyncio
+# print(asyncio.run(base.query("What are the schemes for women entreprenuers in India?")))
\ No newline at end of file
@@ -1,11 +1,19 @@
+import time
+
+import_started = time.perf_counter()
+
+import asyncio
+import json
 import os
-import tempfile
 
-from core.agent import Agent
+from core import metrics, upstream
+from core.admission import AdmissionMiddleware, AdmissionQueue, ClientQuotas
+from core.agent import NMT_CODES, Agent
+from core.attributes import parse_filters
+from core.upstream import UpstreamUnavailable
 from dotenv import load_dotenv
 from fastapi import FastAPI, HTTPException, Request
-from fastapi.responses import JSONResponse
-from google import genai
+from fastapi.responses import JSONResponse, PlainTextResponse, StreamingResponse
 
 import uvicorn
 from fastapi.middleware.cors import CORSMiddleware
@@ -13,6 +21,43 @@ from fastapi.middleware.cors import CORSMiddleware
 load_dotenv()
 
 app = FastAPI()
+
+# Admission control in front of the agent. With RATE_LIMIT_PER_MINUTE set each
+# client gets a token bucket (a request costs its weight below); then at most
+# ADMISSION_CONCURRENCY requests run while up to ADMISSION_QUEUE wait, text
+# before audio before bulk screening and short bodies first, for at most
+# ADMISSION_QUEUE_SECONDS. Over quota is a 429, over capacity a 503, both with
+# Retry-After.
+#
+# Quotas are off by default: the web app calls us from its server-side routes,
+# so every user arrives from the front end's address. Those routes send the
+# user's address in CLIENT_ID_HEADER (X-Client-Id), which is only believed
+# with `Authorization: Bearer $AI_API_KEY`, the key they share with us; other
+# callers are billed by their own address. TRUST_PROXY=1 uses the first
+# X-Forwarded-For hop instead. Only enable quotas with one of the two in
+# place, or the whole site shares a single bucket.
+quotas = ClientQuotas(
+    per_minute=float(os.getenv("RATE_LIMIT_PER_MINUTE", "0")),
+    burst=int(os.getenv("RATE_LIMIT_BURST", "10")),
+    identity_header=os.getenv("CLIENT_ID_HEADER", "X-Client-Id"),
+    identity_secret=os.getenv("AI_API_KEY"),
+    trust_proxy=os.getenv("TRUST_PROXY", "0") == "1",
+)
+admission = AdmissionQueue(
+    max_active=int(os.getenv("ADMISSION_CONCURRENCY", "32")),
+    max_queue=int(os.getenv("ADMISSION_QUEUE", "64")),
+    max_wait=float(os.getenv("ADMISSION_QUEUE_SECONDS", "5")),
+)
+# path: (priority, quota cost); bulk screening is billed per profile once parsed
+ADMITTED_ROUTES = {
+    "/message": (0, 1),
+    "/translate": (0, 1),
+    "/transcribe": (1, 2),
+    "/message/batch": (2, 1),
+}
+# Added before CORS so rejections still carry the CORS headers
+app.add_middleware(AdmissionMiddleware, quotas=quotas, queue=admission, routes=ADMITTED_ROUTES)
+
 # Add CORS middleware
 app.add_middleware(
     CORSMiddleware,
@@ -24,50 +69,160 @@ app.add_middleware(
 
 system_instruction="You are an indian msme grant finder assistant"
 
-# Configure Gemini client
-client = genai.Client(api_key=os.getenv("GOOGLE_API_KEY"))
+# The agent owns the only Gemini client; it is built lazily, see Agent.warm
 agent = Agent(os.getenv("GOOGLE_API_KEY"))
+agent.startup_timings["import"] = round(time.perf_counter() - import_started, 4)
+
+# Send a Server-Timing header with per-stage durations on every response,
+# or only when the client asks with X-Timing: 1
+TIMING_HEADER = os.getenv("TIMING_HEADER", "0") == "1"
+
+@app.middleware("http")
+async def record_timings(request: Request, call_next):
+    timings = metrics.start_request()
+    started = time.perf_counter()
+    response = await call_next(request)
+    route = request.scope.get("route")
+    metrics.REQUEST_SECONDS.observe(route.path if route else "other", time.perf_counter() - started)
+    if timings and (TIMING_HEADER or request.headers.get("x-timing") == "1"):
+        response.headers["Server-Timing"] = metrics.server_timing(timings)
+    return response
+
+# Sent with 503s so clients back off while an upstream is failing
+RETRY_AFTER_SECONDS = os.getenv("RETRY_AFTER_SECONDS", "10")
+
+def error_response(e: Exception):
+    if isinstance(e, UpstreamUnavailable):
+        return JSONResponse(status_code=503, content={"error": str(e)}, headers={"Retry-After": RETRY_AFTER_SECONDS})
+    return JSONResponse(status_code=500, content={"error": str(e)})
+
+def wants_stream(request: Request, body=None):
+    """Clients opt into Server-Sent Events with ?stream=1, `"stream": true` or an event-stream Accept header."""
+    if request.query_params.get("stream", "").lower() in ("1", "true"):
+        return True
+    if isinstance(body, dict) and body.get("stream"):
+        return True
+    return "text/event-stream" in request.headers.get("accept", "")
+
+async def sse(events):
+    try:
+        async for event in events:
+            yield f"data: {json.dumps(event, ensure_ascii=False)}\n\n"
+    except Exception as e:
+        yield f"data: {json.dumps({'type': 'error', 'error': str(e)})}\n\n"
+        yield f"data: {json.dumps({'type': 'done'})}\n\n"
+
+def sse_response(events):
+    return StreamingResponse(
+        sse(events),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
+
+async def warm_in_background():
+    try:
+        await agent.warm()
+    except Exception as e:
+        print(f"Warm-up failed: {e}")
+
+@app.on_event("startup")
+async def startup():
+    # Warm in the background so the port opens immediately; /wakeup waits for it
+    if os.getenv("WARM_ON_STARTUP", "1") == "1":
+        asyncio.create_task(warm_in_background())
+
+@app.on_event("shutdown")
+def shutdown():
+    if agent.loaded:
+        agent.db.embeddings.save()
 
 @app.get("/wakeup")
 async def wakeup():
     try:
         print("Received wakeup request")
-        return JSONResponse(content={"message": "Server is awake!"})
+        timings = await agent.warm()
+        return JSONResponse(content={"message": "Server is awake!", "startup": timings})
     except Exception as e:
         return JSONResponse(status_code=500, content={"error": str(e)})
 
+@app.get("/metrics")
+async def prometheus_metrics():
+    extra = [upstream.metrics(), admission.metrics(), agent.sessions.metrics()] + ([agent.db.metrics()] if agent.loaded else [])
+    return PlainTextResponse(metrics.render(extra), media_type="text/plain; version=0.0.4")
+
 @app.post("/translate")
 async def translate(request: Request):
     try:
         print("Received translation request")
 
         body = await request.json()
+        # English by default; other targets (UI strings) expect English input
+        target = body.get("target", "english")
+        if target not in NMT_CODES:
+            return JSONResponse(status_code=400, content={"error": f"Unsupported target language: {target}"})
+
+        # A list of strings is translated in one batch
+        messages = body.get("messages")
+        if isinstance(messages, list) and messages and all(isinstance(m, str) for m in messages):
+            responses = await agent.translate_many(messages, target=target)
+            return JSONResponse(content={"responses": responses})
+
         user_message = body.get("message")
         if not user_message:
             raise HTTPException(status_code=400, detail="Message is required")
 
-        response = agent.translate(user_message)
+        response = (await agent.translate_many([user_message], target=target))[0]
         return JSONResponse(content={"response": response})
     except Exception as e:
-            return JSONResponse(status_code=500, content={"error": str(e)})
+            return error_response(e)
+
+# Voice clips are held in memory only, so their size is capped
+MAX_AUDIO_BYTES = int(os.getenv("MAX_AUDIO_BYTES", str(20 * 1024 * 1024)))
+
+async def read_limited(request: Request, max_bytes: int, detail: str) -> bytes:
+    """Read the body, failing with 413 as soon as it is known to exceed `max_bytes` (declared or received)."""
+    declared = request.headers.get("content-length")
+    if declared and declared.isdigit() and int(declared) > max_bytes:
+        raise HTTPException(status_code=413, detail=detail)
+
+    chunks = []
+    size = 0
+    async for chunk in request.stream():
+        size += len(chunk)
+        if size > max_bytes:
+            raise HTTPException(status_code=413, detail=detail)
+        chunks.append(chunk)
+    return b"".join(chunks)
+
+async def read_audio(request: Request) -> bytes:
+    return await read_limited(request, MAX_AUDIO_BYTES, "Audio clip is too large")
+
+def audio_mime_type(request: Request) -> str:
+    # The web client posts application/octet-stream; its recordings are mp3
+    content_type = request.headers.get("content-type", "").split(";")[0].strip()
+    return content_type if content_type.startswith("audio/") else "audio/mp3"
 
 @app.post("/transcribe")
 async def transcribe(request: Request):
+    try:
+        audio = await read_audio(request)
+    except HTTPException as e:
+        return JSONResponse(status_code=e.status_code, content={"error": e.detail})
+    if not audio:
+        return JSONResponse(status_code=400, content={"error": "Audio is required"})
 
-    # Read the raw binary data from the request
-    body = await request.body()
-
-    # Save to a temporary file
-    with tempfile.NamedTemporaryFile(delete=False, suffix=".mp3") as tmp:
-        tmp.write(body)
-        tmp_path = tmp.name
+    mime_type = audio_mime_type(request)
+    # The body is the clip itself, so the session travels in the query string
+    session_id = request.query_params.get("session_id")
+    if wants_stream(request):
+        return sse_response(agent.translate_audio_stream(audio, mime_type, session_id))
 
     try:
-        response, language = agent.translate_audio(tmp_path)
-        return JSONResponse(content={"response": response, "language": language})
+        response, language, session_id = await agent.translate_audio(audio, mime_type, session_id)
+        return JSONResponse(content={"response": response, "language": language, "session_id": session_id})
 
     except Exception as e:
-        return JSONResponse(status_code=500, content={"error": str(e)})
+        return error_response(e)
 
 @app.post("/message")
 async def message(request: Request):
@@ -79,14 +234,87 @@ async def message(request: Request):
 
         if not user_message:
             raise HTTPException(status_code=400, detail="Message is required")
+
+        # Optional scheme filters, e.g. {"state": "kerala", "target_group": "women"}
+        try:
+            filters = parse_filters(body.get("filters") or {})
+        except ValueError as e:
+            return JSONResponse(status_code=400, content={"error": str(e)})
+
+        # Send the returned session_id back with follow-up questions to reuse the retrieved schemes
+        session_id = body.get("session_id")
+        if wants_stream(request, body):
+            return sse_response(agent.transliterate_and_query_stream(user_message, session_id, filters))
     
-        response, language = agent.transliterate_and_query(user_message)
-        return JSONResponse(content={"response": response, "language": language})
+        response, language, session_id = await agent.transliterate_and_query(user_message, session_id, filters)
+        return JSONResponse(content={"response": response, "language": language, "session_id": session_id})
     
     except Exception as e:
-            return JSONResponse(status_code=500, content={"error": str(e)})
+            return error_response(e)
     
 
+# Bulk screening requests are read into memory, so they are capped
+MAX_BATCH_BYTES = int(os.getenv("MAX_BATCH_BYTES", str(5 * 1024 * 1024)))
+MAX_BATCH_PROFILES = int(os.getenv("MAX_BATCH_PROFILES", "1000"))
+
+def parse_profiles(text: str):
+    """
+    One profile per line, as {"id", "message", "additional_info", "filters"} or a bare JSON string.
+    Returns (profiles, results for lines that could not be used). Ids default to the line number,
+    which is also the id of lines that are not JSON objects.
+    """
+    profiles, rejected = [], []
+    for number, line in enumerate(text.splitlines(), 1):
+        if not line.strip():
+            continue
+        item = None
+        try:
+            item = json.loads(line)
+            item = {"message": item} if isinstance(item, str) else item
+            if not isinstance(item, dict) or not isinstance(item.get("message"), str) or not item["message"].strip():
+                raise ValueError("message is required")
+            additional_info = item.get("additional_info") or ""
+            if not isinstance(additional_info, str):
+                raise ValueError("additional_info must be a string")
+            profiles.append({
+                "id": item.get("id", number),
+                "message": item["message"],
+                "additional_info": additional_info.strip(),
+                "filters": parse_filters(item.get("filters") or {}),
+            })
+        except ValueError as e:
+            rejected.append({"id": item.get("id", number) if isinstance(item, dict) else number, "error": str(e)})
+    return profiles, rejected
+
+@app.post("/message/batch")
+async def message_batch(request: Request):
+    """Screen a JSONL batch of enterprise profiles; results stream back as JSON lines, in completion order."""
+    print("Received batch request")
+    try:
+        body = await read_limited(request, MAX_BATCH_BYTES, "Batch is too large")
+    except HTTPException as e:
+        return JSONResponse(status_code=e.status_code, content={"error": e.detail})
+
+    profiles, rejected = parse_profiles(body.decode("utf-8", errors="replace"))
+    if len(profiles) > MAX_BATCH_PROFILES:
+        return JSONResponse(status_code=413, content={"error": f"At most {MAX_BATCH_PROFILES} profiles per batch"})
+    if not profiles and not rejected:
+        return JSONResponse(status_code=400, content={"error": "No profiles in batch"})
+    # Admission charged for one profile; the rest come out of the client's bucket now
+    quotas.charge(quotas.client(request), len(profiles) - 1)
+
+    async def results():
+        for result in rejected:
+            yield json.dumps(result, ensure_ascii=False) + "\n"
+        try:
+            async for event in agent.screen(profiles):
+                result = {"id": profiles[event.pop("index")]["id"], **event}
+                yield json.dumps(result, ensure_ascii=False) + "\n"
+        except Exception as e:
+            yield json.dumps({"error": str(e)}) + "\n"
+
+    return StreamingResponse(results(), media_type="application/x-ndjson")
+
 if __name__ == "__main__":
     port = int(os.environ.get("PORT", 8000))
     uvicorn.run(app, host="0.0.0.0", port=port)
\ No newline at end of file
@@ -1,13 +1,27 @@
+import hashlib
+import json
+import multiprocessing
 import os
+import queue
 import re
+import sys
+import threading
 import time
+import uuid
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, ThreadPoolExecutor, wait
 
 import chromadb
 import google.generativeai as gen
 from dotenv import load_dotenv
 from google import genai
 from google.genai import types
-from pdfminer.high_level import extract_text
+from pdfminer.high_level import extract_pages
+from pdfminer.layout import LTContainer, LTText, LTTextBox
+
+from core.attributes import ATTRIBUTES_VERSION, extract_attributes
+from core.context import split_passages
+from core.index import SNAPSHOTS, publish_snapshot, read_current
+from core.lexical import LexicalIndex, chunk_title
 
 # Load environment variables
 load_dotenv()
@@ -35,6 +49,67 @@ def rate_limited(max_per_minute):
         return wrapper
     return decorator
 
+# Token bucket: allows bursts of concurrent calls up to the per-minute quota
+class TokenBucket:
+    def __init__(self, per_minute, capacity=None):
+        self.rate = per_minute / 60
+        self.capacity = capacity or per_minute
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self, n=1):
+        n = min(n, self.capacity)
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= n:
+                    self.tokens -= n
+                    return
+                wait = (n - self.tokens) / self.rate
+            time.sleep(wait)
+
+
+# Progress and throughput reporting
+class Progress:
+    def __init__(self, label, total):
+        self.label = label
+        self.total = total
+        self.done = 0
+        self.started = time.monotonic()
+        self.lock = threading.Lock()
+
+    def update(self, n=1):
+        with self.lock:
+            self.done += n
+            elapsed = time.monotonic() - self.started
+            rate = self.done / elapsed if elapsed else 0.0
+            print(f"{self.label}: {self.count()} ({rate:.1f}/s)")
+
+    def finish(self):
+        elapsed = time.monotonic() - self.started
+        rate = self.done / elapsed if elapsed else 0.0
+        print(f"{self.label}: finished {self.count()} in {elapsed:.1f}s ({rate:.1f}/s)")
+
+    # The total is None while it is still unknown (streamed work)
+    def count(self):
+        return f"{self.done}/{self.total}" if self.total is not None else str(self.done)
+
+
+EXTRACT_WORKERS = int(os.getenv("EXTRACT_WORKERS", os.cpu_count() or 1))
+# Chunks extracted but not yet embedded; workers pause when this many are waiting
+EXTRACT_QUEUE_SIZE = int(os.getenv("EXTRACT_QUEUE_SIZE", "64"))
+EMBED_BATCH_SIZE = int(os.getenv("EMBED_BATCH_SIZE", "100"))
+EMBED_CONCURRENCY = int(os.getenv("EMBED_CONCURRENCY", "4"))
+EMBED_PER_MINUTE = int(os.getenv("EMBED_PER_MINUTE", "1500"))
+UPSERT_BATCH_SIZE = int(os.getenv("UPSERT_BATCH_SIZE", "500"))
+PASSAGE_CHARS = int(os.getenv("PASSAGE_CHARS", "1500"))
+
+embed_bucket = TokenBucket(EMBED_PER_MINUTE)
+
+
 # Enhanced Summary Generation
 @rate_limited(60)
 def generate_scheme_summary(chunk):
@@ -54,93 +129,346 @@ def generate_scheme_summary(chunk):
         return "Scheme summary unavailable"
 
 # Improved Text Processing
-def split_and_trim(text):
-    chunks = re.split(r'\nScheme:\s*|\n##\s*', text)
-    processed_chunks = []
-    
-    for chunk in chunks:
-        # Size control
-        chunk = chunk[:30000] if len(chunk.encode('utf-8')) > 35000 else chunk
-        
-        # Extract eligibility and description (placeholder logic)
-        eligibility = "Eligibility details not available"  # Replace with actual extraction logic
-        description = "Description not available"  # Replace with actual extraction logic
-        
-        contains_application = "How to Apply" in chunk
-        
-        processed_chunks.append({
+CHUNK_SEPARATOR = re.compile(r'\nScheme:\s*|\n##\s*')
+# Longest prefix of a heading that can end a page
+SEPARATOR_LOOKBACK = len("\nScheme:")
+# Size control: chunks over CHUNK_MAX_BYTES keep their first CHUNK_KEEP_CHARS
+CHUNK_MAX_BYTES = 35000
+CHUNK_KEEP_CHARS = 30000
+
+def trim_chunk(chunk):
+    return chunk[:CHUNK_KEEP_CHARS] if len(chunk.encode('utf-8')) > CHUNK_MAX_BYTES else chunk
+
+def iter_chunks(pages):
+    """
+    Split page texts at `Scheme:`/`##` headings, yielding each chunk as soon
+    as the heading after it is seen, so only the chunk in progress is held.
+    Headings may span pages; the chunks are the same as splitting the whole
+    text at once.
+    """
+    head, buffer, resume = None, "", 0
+    # None marks the end of the text, where a trailing heading is complete
+    for page in _with_end(pages):
+        scan_from = min(resume, max(len(buffer) - SEPARATOR_LOOKBACK, 0))
+        buffer += page or ""
+        start, pending = 0, None
+        for match in CHUNK_SEPARATOR.finditer(buffer, scan_from):
+            if page is not None and match.end() == len(buffer):
+                # The heading's trailing whitespace may go on in the next page
+                pending = match.start()
+                break
+            yield head if head is not None else trim_chunk(buffer[start:match.start()])
+            head, start = None, match.end()
+        if page is None:
+            yield head if head is not None else trim_chunk(buffer[start:])
+            return
+
+        resume = len(buffer) if pending is None else pending
+        keep_from = min(resume, max(len(buffer) - SEPARATOR_LOOKBACK, 0))
+        # A chunk longer than this is trimmed anyway: keep its head and the unscanned tail only
+        if head is not None or keep_from - start > CHUNK_MAX_BYTES:
+            head = head if head is not None else buffer[start:start + CHUNK_KEEP_CHARS]
+            start = keep_from
+        buffer, resume = buffer[start:], resume - start
+
+def _with_end(pages):
+    yield from pages
+    yield None
+
+def split_and_trim(pages):
+    # Scalar attributes (scope, state, sector, target groups, sizes,
+    # has_application) that queries can filter on, see core/attributes.py
+    for chunk in iter_chunks(pages):
+        yield {
             "content": chunk,
-            "metadata": {
-                "eligibility": eligibility,
-                "description": description,
-                "has_application": contains_application,
-                "keywords": list(set(re.findall(r'\b\w{4,}\b', chunk.lower())))
-            }
-        })
-    
-    return processed_chunks
+            "metadata": extract_attributes(chunk)
+        }
+
+def page_text(page):
+    """A page's text, laid out the way pdfminer's extract_text writes it."""
+    parts = []
+
+    def render(item):
+        if isinstance(item, LTContainer):
+            for child in item:
+                render(child)
+        elif isinstance(item, LTText):
+            parts.append(item.get_text())
+        if isinstance(item, LTTextBox):
+            parts.append("\n")
+
+    render(page)
+    parts.append("\f")
+    return "".join(parts)
+
+def iter_pages(file_path):
+    for page in extract_pages(file_path):
+        yield page_text(page)
+
+# Set in each extraction worker by init_extract_worker
+_chunk_queue = None
+_stop = None
+
+def init_extract_worker(chunk_queue, stop):
+    global _chunk_queue, _stop
+    _chunk_queue, _stop = chunk_queue, stop
+    # Exiting workers must not wait on chunks nobody will read after a cancel
+    chunk_queue.cancel_join_thread()
+
+def _put(item):
+    while not _stop.is_set():
+        try:
+            _chunk_queue.put(item, timeout=1)
+            return
+        except queue.Full:
+            continue
+    raise RuntimeError("Extraction cancelled")
+
+# Runs in a worker process, so it must stay a top-level function. Chunks go
+# back through the queue as they are found, then (file name, None, error).
+def extract_file(file_path):
+    file_name = os.path.basename(file_path)
+    if _stop.is_set():
+        return
+    try:
+        for chunk in split_and_trim(iter_pages(file_path)):
+            _put((file_name, chunk, None))
+    except Exception as e:
+        if not _stop.is_set():
+            _put((file_name, None, f"{type(e).__name__}: {e}"))
+        return
+    _put((file_name, None, None))
+
+# Stable, content-addressed chunk id
+def chunk_id(content):
+    return hashlib.sha256(content.encode("utf-8")).hexdigest()[:32]
+
+def file_signature(file_path):
+    stat = os.stat(file_path)
+    return {"mtime": stat.st_mtime, "size": stat.st_size}
 
 # Document Loader with Validation
-def load_msme_documents(folder_path):
-    documents = []
-    metadatas = []
-    
-    for file_name in os.listdir(folder_path):
-        if file_name.endswith(".pdf"):
-            file_path = os.path.join(folder_path, file_name)
+# Extracts the given PDFs page by page in a process pool and yields
+# (file name, chunk, None) as chunks are found, then (file name, None, error)
+# once a file is done, error being None on success. At most
+# EXTRACT_QUEUE_SIZE chunks are buffered between the workers and the caller.
+def load_msme_documents(folder_path, file_names):
+    if not file_names:
+        return
+    progress = Progress("Extracted PDFs", len(file_names))
+    chunk_queue = multiprocessing.Queue(EXTRACT_QUEUE_SIZE)
+    stop = multiprocessing.Event()
+    remaining = set(file_names)
+
+    with ProcessPoolExecutor(max_workers=EXTRACT_WORKERS, initializer=init_extract_worker, initargs=(chunk_queue, stop)) as pool:
+        try:
+            futures = {pool.submit(extract_file, os.path.join(folder_path, f)): f for f in file_names}
+            while remaining:
+                try:
+                    file_name, chunk, error = chunk_queue.get(timeout=1)
+                except queue.Empty:
+                    # A worker that died (e.g. BrokenProcessPool) never reports back
+                    for future, file_name in futures.items():
+                        if file_name in remaining and future.done() and future.exception():
+                            remaining.discard(file_name)
+                            progress.update()
+                            yield file_name, None, str(future.exception())
+                    continue
+                if file_name not in remaining:
+                    continue
+                if chunk is None:
+                    remaining.discard(file_name)
+                    progress.update()
+                yield file_name, chunk, error
+        finally:
+            # Unblocks workers waiting on a full queue if the caller stopped early
+            stop.set()
+            pool.shutdown(cancel_futures=True)
+    progress.finish()
+
+# Manifest of {file name: {"signature": {mtime, size}, "attributes": version, "chunks": [chunk ids]}}
+def load_manifest(db_path):
+    try:
+        with open(os.path.join(db_path, "manifest.json"), "r", encoding="utf-8") as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+def save_manifest(db_path, manifest):
+    tmp_path = os.path.join(db_path, "manifest.json.tmp")
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        json.dump(manifest, f, indent=1)
+    os.replace(tmp_path, os.path.join(db_path, "manifest.json"))
+
+# Build stamp read by the API server to invalidate cached answers
+def new_build_id():
+    return f"{int(time.time())}-{uuid.uuid4().hex[:8]}"
+
+def write_build_id(db_path="./msme_db", build_id=None):
+    build_id = build_id or new_build_id()
+    tmp_path = os.path.join(db_path, "build_id.tmp")
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        f.write(build_id)
+    os.replace(tmp_path, os.path.join(db_path, "build_id"))
+    return build_id
+
+# One batched embedding request, throttled by the shared token bucket
+def embed_batch(texts):
+    embed_bucket.acquire(len(texts))
+    response = client.models.embed_content(
+        model="models/embedding-001",
+        contents=texts,
+        config=types.EmbedContentConfig(task_type="RETRIEVAL_DOCUMENT")
+    )
+    return [e.values for e in response.embeddings]
+
+# Embeds and upserts passages as they arrive. New ones are embedded in
+# batches of EMBED_BATCH_SIZE with up to EMBED_CONCURRENCY batches in flight
+# and upserted as each batch returns; passages already in the collection only
+# get their metadata refreshed. Only the batches in flight are held in memory.
+class PassageWriter:
+    def __init__(self, collection, existing):
+        self.collection = collection
+        self.existing = existing
+        self.seen = set()
+        self.batch = []
+        self.retag = []
+        self.in_flight = {}
+        # Ids of passages whose embedding failed
+        self.failed = set()
+        self.retagged = 0
+        self.pool = ThreadPoolExecutor(max_workers=EMBED_CONCURRENCY)
+        self.progress = Progress("Embedded passages", None)
+
+    # Each scheme chunk is stored as passages linked to it through `parent`;
+    # later passages are embedded with the scheme title for context.
+    # Returns the chunk's passage ids.
+    def add(self, file_name, chunk):
+        ids = []
+        parent = chunk_id(chunk["content"])
+        title = chunk_title(chunk["content"])
+        for j, passage in enumerate(split_passages(chunk["content"], PASSAGE_CHARS)):
+            cid = chunk_id(f"{parent}:{passage}")
+            ids.append(cid)
+            if cid in self.seen:
+                continue
+            self.seen.add(cid)
+            metadata = {**chunk["metadata"], "source": file_name, "parent": parent, "passage": j, "title": title}
+            if cid in self.existing:
+                self.retag.append((cid, metadata))
+                if len(self.retag) >= UPSERT_BATCH_SIZE:
+                    self._update()
+            else:
+                self.batch.append((cid, passage, metadata, passage if j == 0 else f"{title}\n{passage}"))
+                if len(self.batch) >= EMBED_BATCH_SIZE:
+                    self._submit()
+        return ids
+
+    def _submit(self):
+        batch, self.batch = self.batch, []
+        while len(self.in_flight) >= EMBED_CONCURRENCY:
+            self._drain(FIRST_COMPLETED)
+        self.in_flight[self.pool.submit(embed_batch, [item[3] for item in batch])] = batch
+
+    # Upserts finished batches from this thread; Chroma is only used here
+    def _drain(self, return_when):
+        done, _ = wait(self.in_flight, return_when=return_when)
+        for future in done:
+            batch = self.in_flight.pop(future)
             try:
-                text = extract_text(file_path)
-                chunks = split_and_trim(text)
-                
-                for chunk in chunks:
-                    documents.append(chunk["content"])
-                    metadatas.append(chunk["metadata"])
+                embeddings = future.result()
             except Exception as e:
-                print(f"Error processing {file_name}: {e}")
-    
-    return documents, metadatas
+                print(f"Embedding failed for {len(batch)} passages: {e}")
+                self.failed.update(item[0] for item in batch)
+                continue
+            self.collection.upsert(
+                ids=[item[0] for item in batch],
+                documents=[item[1] for item in batch],
+                embeddings=embeddings,
+                metadatas=[item[2] for item in batch]
+            )
+            self.progress.update(len(batch))
 
-# Database Initialization with Validation
-def create_scheme_database(documents, metadatas):
-    client = chromadb.PersistentClient(path="./msme_db")
+    def _update(self):
+        batch, self.retag = self.retag, []
+        self.collection.update(ids=[cid for cid, _ in batch], metadatas=[metadata for _, metadata in batch])
+        self.retagged += len(batch)
+
+    def close(self):
+        if self.batch:
+            self._submit()
+        while self.in_flight:
+            self._drain(FIRST_COMPLETED)
+        if self.retag:
+            self._update()
+        self.pool.shutdown()
+        self.progress.finish()
+
+# Incremental Database Update
+# Only changed PDFs are extracted, only chunks not yet in the collection are
+# embedded, and chunks no longer produced by any PDF are deleted. Extraction,
+# embedding and upserts run as one pipeline, so memory stays bounded by the
+# chunks in flight rather than the corpus.
+def update_scheme_database(folder_path, db_path="./msme_db"):
+    client = chromadb.PersistentClient(path=db_path)
     collection = client.get_or_create_collection("msme_schemes")
-    
-    embeddings = []
-    for doc in documents:
-        try:
-            embedding = genai.embed_content(
-                model="models/embedding-001",
-                content=doc,
-                task_type="retrieval_document"
-            )["embedding"]
-            embeddings.append(embedding)
-        except Exception as e:
-            print(f"Embedding failed: {e}")
-            continue
-    
-    # Batch insert with metadata
-    batch_size = 5
-    valid_ids = []
-    valid_docs = []
-    valid_embeds = []
-    valid_metas = []
-    
-    for i in range(0, len(documents)):
-        if i < len(embeddings):  # Skip failed embeddings
-            valid_ids.append(str(i))
-            valid_docs.append(documents[i])
-            valid_embeds.append(embeddings[i])
-            valid_metas.append(metadatas[i])
-    
-    # Upsert valid entries
-    for i in range(0, len(valid_docs), batch_size):
-        collection.upsert(
-            ids=valid_ids[i:i+batch_size],
-            documents=valid_docs[i:i+batch_size],
-            embeddings=valid_embeds[i:i+batch_size],
-            metadatas=valid_metas[i:i+batch_size]
+    manifest = load_manifest(db_path)
+
+    file_names = sorted(f for f in os.listdir(folder_path) if f.endswith(".pdf"))
+    signatures = {f: file_signature(os.path.join(folder_path, f)) for f in file_names}
+    # Files tagged by older attribute rules are re-extracted to refresh their metadata
+    changed = [
+        f for f in file_names
+        if manifest.get(f, {}).get("signature") != signatures[f]
+        or manifest.get(f, {}).get("attributes") != ATTRIBUTES_VERSION
+    ]
+    print(f"{len(changed)} of {len(file_names)} PDFs new, changed or re-tagged")
+
+    existing = set(collection.get(include=[])["ids"])
+    new_manifest = {f: manifest[f] for f in file_names if f not in changed}
+    ids = {f: [] for f in changed}
+    writer = PassageWriter(collection, existing)
+    try:
+        for file_name, chunk, error in load_msme_documents(folder_path, changed):
+            if chunk is not None:
+                if chunk["content"].strip():
+                    ids[file_name] += writer.add(file_name, chunk)
+            elif error is None:
+                new_manifest[file_name] = {"signature": signatures[file_name], "attributes": ATTRIBUTES_VERSION, "chunks": ids.pop(file_name)}
+            else:
+                print(f"Error processing {file_name}: {error}")
+                # Extraction failed: keep the previous chunks (and any already
+                # stored this run) and retry next time
+                previous = manifest.get(file_name, {})
+                chunks = list(dict.fromkeys(previous.get("chunks", []) + ids.pop(file_name)))
+                new_manifest[file_name] = {**previous, "signature": None, "chunks": chunks}
+    finally:
+        writer.close()
+
+    # Files with chunks that failed to embed are retried on the next run
+    for file_name, entry in new_manifest.items():
+        if writer.failed.intersection(entry["chunks"]):
+            entry["signature"] = None
+
+    referenced = {cid for entry in new_manifest.values() for cid in entry["chunks"]}
+    stale = sorted(existing - referenced)
+    for i in range(0, len(stale), UPSERT_BATCH_SIZE):
+        collection.delete(ids=stale[i:i+UPSERT_BATCH_SIZE])
+    print(f"{writer.progress.done} passages embedded, {writer.retagged} re-tagged, {len(stale)} deleted")
+
+    save_manifest(db_path, new_manifest)
+    current = read_current(db_path)
+    # Snapshots published before the keyword index moved into them are rebuilt once
+    if writer.progress.done or writer.retagged or stale or current is None or not LexicalIndex.exists(os.path.join(db_path, SNAPSHOTS, current)):
+        build_id = new_build_id()
+        # Read-only snapshot shared by all API workers (RETRIEVAL_BACKEND=numpy),
+        # with the keyword index for name lookups and hybrid ranking (core/lexical.py)
+        publish_snapshot(
+            collection, build_id, db_path,
+            dtype=os.getenv("NUMPY_INDEX_DTYPE", "float32"),
+            keep=int(os.getenv("SNAPSHOT_KEEP", "3")),
         )
-    
+        write_build_id(db_path, build_id)
     return collection
 
 
@@ -240,17 +568,23 @@ Only show schemes that are a good match. If no scheme matches, suggest visiting
 def main():
     print("\n🔍 MSME Scheme Recommendation Assistant")
     
-    # Initialize database
-    if not os.path.exists("./msme_db"):
-        print("Building knowledge base...")
-        docs, metas = load_msme_documents("./msme-docs")
-        if not docs:
+    # Initialize or incrementally update the database
+    if os.path.isdir("./msme-docs"):
+        print("Updating knowledge base...")
+        db = update_scheme_database("./msme-docs")
+        if db.count() == 0:
             print("No valid documents found. Check PDF files and try again.")
             return
-        db = create_scheme_database(docs, metas)
-    else:
+    elif os.path.exists("./msme_db"):
         client = chromadb.PersistentClient(path="./msme_db")
         db = client.get_collection("msme_schemes")
+    else:
+        print("No valid documents found. Check PDF files and try again.")
+        return
+
+    # `python msme-rag.py index` only refreshes the knowledge base
+    if sys.argv[1:] == ["index"]:
+        return
     
     # Interactive session
     print("Type 'exit' to quit\n")
@@ -0,0 +1,53 @@
+import asyncio
+
+import pytest
+
+from core.upstream import CircuitBreaker, Upstream, UpstreamUnavailable
+
+
+def open_breaker():
+    breaker = CircuitBreaker("test", failure_threshold=1, reset_timeout=0)
+    breaker.failure()
+    return breaker
+
+
+def test_cancelled_half_open_trial_frees_the_trial():
+    breaker = open_breaker()
+    upstream = Upstream("stage", breaker, timeout=5, retries=0)
+
+    async def hang():
+        await asyncio.sleep(10)
+
+    async def ok():
+        return "ok"
+
+    async def run():
+        trial = asyncio.ensure_future(upstream.call(hang))
+        await asyncio.sleep(0.01)
+        assert breaker.trial
+        trial.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await trial
+        return await upstream.call(ok)
+
+    assert asyncio.run(run()) == "ok"
+    assert breaker.state == "closed"
+
+
+def test_open_circuit_rejects_other_calls_during_trial():
+    breaker = open_breaker()
+    upstream = Upstream("stage", breaker, timeout=5, retries=0)
+
+    async def slow():
+        await asyncio.sleep(0.05)
+        return "ok"
+
+    async def run():
+        trial = asyncio.ensure_future(upstream.call(slow))
+        await asyncio.sleep(0.01)
+        with pytest.raises(UpstreamUnavailable):
+            await upstream.call(slow)
+        return await trial
+
+    assert asyncio.run(run()) == "ok"
+    assert breaker.state == "closed"